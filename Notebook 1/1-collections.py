@@ -366,6 +366,606 @@ for _ in range(5):
 print("\n(Passed!))")
 
 
+# **Aside: an array-backed sparse vector.** The dictionary-of-lists representation is convenient, but each index and value is a separate Python object (an `int` or `float` of 24+ bytes, plus an 8-byte list slot). Moreover, `decompress_vector` as written above rescans all of `d['inds']` for every position of the output, so it takes time proportional to $n \cdot \mathrm{nnz}$, where $\mathrm{nnz}$ is the number of stored entries.
+# 
+# The class `SparseVector` below stores the same information in two typed arrays from the standard [`array`](https://docs.python.org/3/library/array.html) module: the indices as 64-bit integers (`array('q')`) and the values as doubles (`array('d')`), i.e., 8 bytes per entry each. It declares `__slots__`, so its instances carry no per-object `__dict__`. Its `decompress` method makes one pass over the stored entries, adding each value into a vector of zeros, so it takes time proportional to $n + \mathrm{nnz}$ and still sums repeated indices. The methods `from_dict` and `to_dict` convert to and from the `{'inds': ..., 'vals': ...}` representation.
+
+# In[ ]:
+
+
+from array import array
+
+class SparseVector:
+    """
+    A compressed vector of length `n`: parallel arrays of indices and
+    values, where the values of repeated indices are summed.
+    """
+    __slots__ = ('n', 'inds', 'vals', '_canonical')
+
+    def __init__(self, inds=(), vals=(), n=None):
+        self.inds = array('q', inds)
+        self.vals = array('d', vals)
+        assert len(self.inds) == len(self.vals), "Length mismatch"
+        i_max = max(self.inds) if self.inds else -1
+        if n is None:
+            n = i_max+1
+        else:
+            assert n > i_max, "Bad value for full vector length"
+        assert not self.inds or min(self.inds) >= 0, "Negative index"
+        self.n = n
+        self._canonical = None
+
+    @classmethod
+    def _from_arrays(cls, inds, vals, n):
+        """Wraps arrays already known to be sorted and free of repeats."""
+        v = cls.__new__(cls)
+        v.inds, v.vals, v.n = inds, vals, n
+        v._canonical = v
+        return v
+
+    @classmethod
+    def compress(cls, x):
+        """Returns the non-zero entries of the full vector `x`."""
+        inds = [i for i, v in enumerate(x) if v != 0]
+        return cls(inds, [x[i] for i in inds], len(x))
+
+    @classmethod
+    def from_dict(cls, d, n=None):
+        assert type(d) is dict and 'inds' in d and 'vals' in d, "Not a dictionary or missing keys"
+        return cls(d['inds'], d['vals'], n)
+
+    def to_dict(self):
+        return {'inds': self.inds.tolist(), 'vals': self.vals.tolist()}
+
+    def decompress(self):
+        """Returns the full vector, as a list, summing repeated indices."""
+        x = [0.0] * self.n
+        for i, v in zip(self.inds, self.vals):
+            x[i] += v
+        return x
+
+    @property
+    def nnz(self):
+        return len(self.inds)
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return "SparseVector({}, {}, n={})".format(self.inds.tolist(), self.vals.tolist(), self.n)
+
+    def canonical(self):
+        """
+        Returns an equivalent vector whose indices are sorted and free of
+        repeats. It is computed on first use and then cached, so the
+        arrays must not be modified afterwards.
+        """
+        if self._canonical is None:
+            inds, vals = self.inds, self.vals
+            if all(inds[k] < inds[k+1] for k in range(len(inds)-1)):
+                self._canonical = self
+            else:
+                c_inds, c_vals = array('q'), array('d')
+                for k in sorted(range(len(inds)), key=inds.__getitem__): # stable
+                    if c_inds and c_inds[-1] == inds[k]:
+                        c_vals[-1] += vals[k]
+                    else:
+                        c_inds.append(inds[k])
+                        c_vals.append(0.0 + vals[k])
+                self._canonical = SparseVector._from_arrays(c_inds, c_vals, self.n)
+        return self._canonical
+
+    def dot(self, other):
+        assert self.n == other.n, "Length mismatch"
+        a, b = self.canonical(), other.canonical()
+        total, p, q = 0.0, 0, 0
+        while p < len(a.inds) and q < len(b.inds):
+            if a.inds[p] < b.inds[q]:
+                p += 1
+            elif a.inds[p] > b.inds[q]:
+                q += 1
+            else:
+                total += a.vals[p] * b.vals[q]
+                p += 1
+                q += 1
+        return total
+
+    def add(self, other):
+        assert self.n == other.n, "Length mismatch"
+        a, b = self.canonical(), other.canonical()
+        inds, vals = array('q'), array('d')
+        p, q = 0, 0
+        while p < len(a.inds) and q < len(b.inds):
+            if a.inds[p] < b.inds[q]:
+                inds.append(a.inds[p])
+                vals.append(a.vals[p])
+                p += 1
+            elif a.inds[p] > b.inds[q]:
+                inds.append(b.inds[q])
+                vals.append(b.vals[q])
+                q += 1
+            else:
+                inds.append(a.inds[p])
+                vals.append(a.vals[p] + b.vals[q])
+                p += 1
+                q += 1
+        for c, k in [(a, p), (b, q)]:
+            inds.extend(c.inds[k:])
+            vals.extend(c.vals[k:])
+        return SparseVector._from_arrays(inds, vals, self.n)
+
+    def scale(self, alpha):
+        a = self.canonical()
+        return SparseVector._from_arrays(array('q', a.inds), array('d', [alpha*v for v in a.vals]), self.n)
+
+    def multiply(self, other):
+        """Returns the elementwise product of `self` and `other`."""
+        assert self.n == other.n, "Length mismatch"
+        a, b = self.canonical(), other.canonical()
+        inds, vals = array('q'), array('d')
+        p, q = 0, 0
+        while p < len(a.inds) and q < len(b.inds):
+            if a.inds[p] < b.inds[q]:
+                p += 1
+            elif a.inds[p] > b.inds[q]:
+                q += 1
+            else:
+                inds.append(a.inds[p])
+                vals.append(a.vals[p] * b.vals[q])
+                p += 1
+                q += 1
+        return SparseVector._from_arrays(inds, vals, self.n)
+
+# Demo:
+x = [0.0, 0.87, 0.0, 0.0, 0.0, 0.32, 0.46, 0.0, 0.0, 0.10, 0.0, 0.0]
+print(SparseVector.compress(x))
+print(SparseVector([0, 3, 7, 3, 3, 5, 1], [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]).decompress())
+
+
+# In[ ]:
+
+
+# `sparse_vector_test`: Test cell
+from sys import getsizeof
+
+for _ in range(5):
+    x = [float("{:.2f}".format(random())) if random() <= 0.2 else 0.0 for _ in range(20)]
+    v = SparseVector.compress(x)
+    assert v.to_dict() == compress_vector(x) and len(v) == len(x)
+    assert v.decompress() == x
+
+for _ in range(5):
+    (d, x_true) = gen_cvec_reps(0.2, 10)
+    for n in [None, 15]:
+        v = SparseVector.from_dict(d, n)
+        assert v.to_dict() == d
+        assert v.decompress() == decompress_vector(d, n)
+        assert len(v) == len(decompress_vector(d, n))
+
+v = SparseVector()
+assert len(v) == 0 and v.nnz == 0 and v.decompress() == [] and v.to_dict() == {'inds': [], 'vals': []}
+assert SparseVector([], [], 5).decompress() == [0.0] * 5
+assert not hasattr(v, '__dict__')
+for bad in [lambda: SparseVector([1, 2], [1.0]), lambda: SparseVector([5], [1.0], 5), lambda: SparseVector([-1], [1.0], 5)]:
+    try:
+        bad()
+        assert False, "Expected an error"
+    except AssertionError as e:
+        assert str(e) != "Expected an error"
+
+# Bigger vectors: a compact representation, and decompression linear in n + nnz
+(d, x_true) = gen_cvec_reps(0.1, 5000)
+v = SparseVector.from_dict(d)
+assert v.decompress() == decompress_vector(d)
+print("Bytes for {} entries: lists {}, arrays {}".format(
+      v.nnz, sum(getsizeof(L) + sum(map(getsizeof, L)) for L in d.values()),
+      getsizeof(v) + getsizeof(v.inds) + getsizeof(v.vals)))
+get_ipython().magic('timeit -n 1 -r 1 decompress_vector(d)')
+get_ipython().magic('timeit v.decompress()')
+
+print("\n(Passed!)")
+
+
+# **Sparse vector algebra.** To compute with compressed vectors, we should not have to decompress them. If the indices of two vectors are sorted and have no repeats, then we can walk through both index arrays at once, like the merge step of merge sort, and visit each stored entry just once:
+# 
+# - `a.dot(b)`, the dot product, and `a.multiply(b)`, the elementwise product, need only the indices that appear in both;
+# - `a.add(b)` needs the indices that appear in either; and
+# - `a.scale(alpha)` multiplies every value by `alpha`.
+# 
+# Vectors whose indices are unsorted or repeated are first put into that _canonical_ form by `canonical()`, which sorts the entries by index and sums the values of repeated indices. Since it is a sort, it is the most expensive step; so it happens only when an operation first needs it, and the result is cached in the vector. The results of all of these operations are already canonical.
+
+# In[ ]:
+
+
+# `sparse_vector_algebra_test`: Test cell
+def dense_dot(x, y):
+    return sum(x_i * y_i for x_i, y_i in zip(x, y))
+
+(d, x_true) = gen_cvec_reps(0.2, 10)
+v = SparseVector.from_dict(d)
+assert v.canonical() is v.canonical() and v.canonical().canonical() is v.canonical()
+assert v.canonical().decompress() == v.decompress()
+assert list(v.canonical().inds) == sorted(set(d['inds']))
+w = SparseVector([1, 4, 6], [1.0, 2.0, 3.0], n=10)
+assert w.canonical() is w
+
+for _ in range(20):
+    n = randrange(1, 200)
+    (d1, x1), (d2, x2) = gen_cvec_reps(random(), n), gen_cvec_reps(random(), n)
+    v1, v2 = SparseVector.from_dict(d1, n), SparseVector.from_dict(d2, n)
+    x1, x2 = v1.decompress(), v2.decompress()
+    assert v1.dot(v2) == dense_dot(x1, x2) and v1.dot(v2) == v2.dot(v1)
+    assert v1.add(v2).decompress() == [a + b for a, b in zip(x1, x2)]
+    assert v1.multiply(v2).decompress() == [a * b for a, b in zip(x1, x2)]
+    assert v1.scale(-2.5).decompress() == [-2.5 * a for a in x1]
+    for result in [v1.add(v2), v1.multiply(v2), v1.scale(3.0)]:
+        assert result.canonical() is result and len(result) == n
+        assert list(result.inds) == sorted(set(result.inds))
+    assert set(v1.multiply(v2).inds) == set(find_common_inds(d1, d2))
+
+empty = SparseVector([], [], 5)
+assert empty.dot(empty) == 0.0 and empty.add(empty).nnz == 0 and empty.scale(2.0).nnz == 0
+try:
+    v1.dot(SparseVector([], [], v1.n + 1))
+    assert False, "Expected a length mismatch"
+except AssertionError as e:
+    assert str(e) == "Length mismatch"
+
+# Timing: the first product canonicalizes the vectors; later ones reuse the cached forms
+(d1, _), (d2, _) = gen_cvec_reps(0.01, 200000), gen_cvec_reps(0.01, 200000)
+v1, v2 = SparseVector.from_dict(d1, 200000), SparseVector.from_dict(d2, 200000)
+x1, x2 = v1.decompress(), v2.decompress()
+assert v1.dot(v2) == dense_dot(x1, x2)
+get_ipython().magic('timeit v1.dot(v2)')
+get_ipython().magic('timeit dense_dot(x1, x2)')
+
+print("\n(Passed!)")
+
+
+# **Aside: NumPy fast paths.** Both `compress_vector` and `decompress_vector` loop over their inputs in Python. When the vectors are NumPy arrays, the same work can be done by vectorized kernels:
+# 
+# - to compress, [`np.flatnonzero`](https://docs.scipy.org/doc/numpy/reference/generated/numpy.flatnonzero.html) finds the positions of the non-zero entries, and fancy indexing gathers their values;
+# - to decompress, [`np.bincount`](https://docs.scipy.org/doc/numpy/reference/generated/numpy.bincount.html) with `weights` scatters the values into a vector of zeros, adding up repeated indices. It always produces double-precision sums, so for values of any other type (e.g., integers or `float32`) we use [`np.add.at`](https://docs.scipy.org/doc/numpy/reference/generated/numpy.ufunc.at.html) instead, which keeps the input type.
+# 
+# Both kernels add the values of a repeated index in the order in which they are stored, just as the list versions do, so the results are identical, not merely close. The versions of `compress_vector` and `decompress_vector` below use the fast paths when given NumPy arrays (and return NumPy arrays), and fall back to the list versions otherwise.
+
+# In[ ]:
+
+
+import numpy as np
+from functools import wraps
+from inspect import unwrap
+
+def compress_vector_numpy(x):
+    inds = np.flatnonzero(x)
+    return {'inds': inds, 'vals': x[inds]}
+
+def decompress_vector_numpy(d, n=None):
+    inds, vals = np.asarray(d['inds']), np.asarray(d['vals'])
+    assert inds.ndim == 1 and inds.shape == vals.shape, "Length mismatch"
+    i_max = inds.max() if len(inds) else -1
+    if n is None:
+        n = i_max+1
+    else:
+        assert n > i_max, "Bad value for full vector length"
+    if vals.dtype == np.float64:
+        return np.bincount(inds, weights=vals, minlength=n)
+    x = np.zeros(n, dtype=vals.dtype)
+    np.add.at(x, inds, vals)
+    return x
+
+# The list versions, from Exercises 2 and 3. (`unwrap` still finds them if this cell runs again.)
+compress_vector_list = unwrap(compress_vector)
+decompress_vector_list = unwrap(decompress_vector)
+
+@wraps(compress_vector_list)
+def compress_vector(x):
+    if isinstance(x, np.ndarray):
+        return compress_vector_numpy(x)
+    return compress_vector_list(x)
+
+@wraps(decompress_vector_list)
+def decompress_vector(d, n=None):
+    assert type(d) is dict and 'inds' in d and 'vals' in d, "Not a dictionary or missing keys"
+    if isinstance(d['inds'], np.ndarray) or isinstance(d['vals'], np.ndarray):
+        return decompress_vector_numpy(d, n)
+    return decompress_vector_list(d, n)
+
+# Demo:
+x = np.array([0.0, 0.87, 0.0, 0.0, 0.0, 0.32, 0.46, 0.0, 0.0, 0.10, 0.0, 0.0])
+print(compress_vector(x))
+print(decompress_vector({'inds': np.array([0, 3, 7, 3, 3, 5, 1]),
+                         'vals': np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0])}))
+
+
+# In[ ]:
+
+
+# `numpy_vector_test`: Test cell
+def check_same_vector_results(x):
+    d_np = compress_vector(np.array(x))
+    d = compress_vector(x)
+    assert type(d['inds']) is list and type(d_np['inds']) is np.ndarray
+    assert d_np['inds'].tolist() == d['inds'] and d_np['vals'].tolist() == d['vals']
+    assert decompress_vector(d_np, len(x)).tolist() == decompress_vector(d, len(x))
+
+check_same_vector_results([0.0, 0.87, 0.0, 0.0, 0.0, 0.32, 0.46, 0.0, 0.0, 0.10, 0.0, 0.0])
+check_same_vector_results([0.0] * 10)
+check_same_vector_results([0, 3, 0, -2, 0])
+for _ in range(5):
+    check_same_vector_results([random() if random() <= 0.2 else 0.0 for _ in range(1000)])
+
+# Repeated indices are summed in the same order, so the sums are bit-for-bit identical
+for _ in range(5):
+    (d, x_true) = gen_cvec_reps(0.2, 1000)
+    d_np = {'inds': np.array(d['inds']), 'vals': np.array(d['vals'])}
+    for n in [None, 1200]:
+        assert decompress_vector(d_np, n).tolist() == decompress_vector(d, n)
+    d_int = {'inds': d['inds'], 'vals': [int(100*v) for v in d['vals']]}
+    x_int = decompress_vector({'inds': np.array(d_int['inds']), 'vals': np.array(d_int['vals'])})
+    assert x_int.dtype.kind == 'i' and x_int.tolist() == decompress_vector(d_int)
+    x_single = decompress_vector({'inds': np.array(d['inds']), 'vals': np.array(d['vals'], dtype=np.float32)})
+    assert x_single.dtype == np.float32
+
+assert len(decompress_vector({'inds': np.array([], dtype=int), 'vals': np.array([])})) == 0
+assert decompress_vector({'inds': np.array([], dtype=int), 'vals': np.array([])}, 5).tolist() == [0.0] * 5
+assert decompress_vector_list is not decompress_vector and compress_vector_list is not compress_vector
+assert unwrap(decompress_vector) is decompress_vector_list and unwrap(compress_vector) is compress_vector_list
+
+print("\n(Passed!)")
+
+
+# **Benchmark.** How much faster are the fast paths on vectors with a million entries, 10% of which are non-zero? (The list version of `decompress_vector` takes time proportional to $n \cdot \mathrm{nnz}$, as noted above, so we time it on a vector of only ten thousand entries.)
+
+# In[ ]:
+
+
+n_big = 1000000
+x_big_np = np.where(np.random.random(n_big) <= 0.1, np.random.random(n_big), 0.0)
+x_big = x_big_np.tolist()
+d_big_np = compress_vector(x_big_np)
+d_big = compress_vector(x_big)
+assert d_big_np['inds'].tolist() == d_big['inds'] and d_big_np['vals'].tolist() == d_big['vals']
+
+n_small = 10000
+d_small_np = compress_vector(x_big_np[:n_small])
+d_small = compress_vector(x_big[:n_small])
+assert decompress_vector(d_small_np, n_small).tolist() == decompress_vector(d_small, n_small)
+
+get_ipython().magic('timeit compress_vector(x_big)')
+get_ipython().magic('timeit compress_vector(x_big_np)')
+get_ipython().magic('timeit -n 1 -r 1 decompress_vector(d_small, n_small)')
+get_ipython().magic('timeit decompress_vector(d_small_np, n_small)')
+get_ipython().magic('timeit decompress_vector(d_big_np, n_big)')
+
+
+# **Aside: many compressed vectors at once.** Suppose we have a compressed vector for each of millions of users. As separate dictionaries, each one costs a `dict`, two lists and a Python object per entry. Instead, we can pack all of them, one after the other, into three contiguous arrays, in what is known as the _compressed sparse row_ (CSR) layout:
+# 
+# - `inds` and `vals` hold the indices and values of all the vectors, concatenated;
+# - `indptr` has one more element than there are vectors, and vector `k` is stored at positions `indptr[k]:indptr[k+1]` of `inds` and `vals`.
+# 
+# The class `CompressedVectors` below builds this layout in bulk from a list of compressed vectors, such as the output of `compress_vector`. Indexing it with an integer `k` returns vector `k` as a compressed vector whose `inds` and `vals` are NumPy _views_ of the shared arrays, and indexing it with a slice returns another `CompressedVectors` that shares all three arrays; neither copies any entries. Its `matvec` method computes the dot product of every vector with a dense vector `x`, i.e., the matrix-vector product, in a few vectorized operations.
+
+# In[ ]:
+
+
+from itertools import chain
+
+class CompressedVectors:
+    """
+    A sequence of compressed vectors of length `n`, all stored in three
+    arrays: `indptr`, `inds` and `vals`.
+    """
+    def __init__(self, indptr, inds, vals, n):
+        self.indptr = indptr
+        self.inds = inds
+        self.vals = vals
+        self.n = n
+
+    @classmethod
+    def from_dicts(cls, dicts, n=None):
+        """Packs a list of `{'inds': ..., 'vals': ...}` vectors."""
+        sizes = np.fromiter((len(d['inds']) for d in dicts), dtype=np.int64, count=len(dicts))
+        assert all(len(d['vals']) == size for d, size in zip(dicts, sizes.tolist())), "Length mismatch"
+        indptr = np.zeros(len(dicts)+1, dtype=np.int64)
+        np.cumsum(sizes, out=indptr[1:])
+        inds = np.fromiter(chain.from_iterable(d['inds'] for d in dicts), dtype=np.int64, count=indptr[-1])
+        vals = np.fromiter(chain.from_iterable(d['vals'] for d in dicts), dtype=np.float64, count=indptr[-1])
+        i_max = inds.max() if len(inds) else -1
+        if n is None:
+            n = i_max+1
+        else:
+            assert n > i_max, "Bad value for full vector length"
+        return cls(indptr, inds, vals, n)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(len(self))
+            assert step == 1, "Only contiguous slices are supported"
+            return CompressedVectors(self.indptr[start:max(start, stop)+1], self.inds, self.vals, self.n)
+        if k < 0:
+            k += len(self)
+        lo, hi = self.indptr[k], self.indptr[k+1]
+        return {'inds': self.inds[lo:hi], 'vals': self.vals[lo:hi]}
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def matvec(self, x):
+        """Returns the dot product of each vector with the dense vector `x`."""
+        x = np.asarray(x)
+        assert x.shape == (self.n,), "Length mismatch"
+        lo, hi = self.indptr[0], self.indptr[-1]
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        return np.bincount(rows, weights=self.vals[lo:hi] * x[self.inds[lo:hi]], minlength=len(self))
+
+    @property
+    def nbytes(self):
+        lo, hi = self.indptr[0], self.indptr[-1]
+        return self.indptr.nbytes + self.inds[lo:hi].nbytes + self.vals[lo:hi].nbytes
+
+# Demo:
+users = CompressedVectors.from_dicts([compress_vector([0.0, 0.87, 0.0, 0.32]),
+                                      compress_vector([0.0, 0.0, 0.0, 0.0]),
+                                      {'inds': [3, 0, 3], 'vals': [1.0, 2.0, 3.0]}])
+print(users.indptr, users.inds, users.vals)
+print(users[2], users[1:].matvec([1.0, 1.0, 1.0, 10.0]))
+
+
+# In[ ]:
+
+
+# `compressed_vectors_test`: Test cell
+def gen_compressed_rows(num_rows, n, p_nz=0.2):
+    return [gen_cvec_reps(p_nz * random(), n)[0] for _ in range(num_rows)]
+
+dicts = gen_compressed_rows(50, 30) + [{'inds': [], 'vals': []}]
+X = CompressedVectors.from_dicts(dicts, 30)
+assert len(X) == len(dicts) and X.n == 30
+assert len(X.inds) == len(X.vals) == sum(len(d['inds']) for d in dicts)
+for k, d in enumerate(dicts):
+    assert X[k]['inds'].tolist() == d['inds'] and X[k]['vals'].tolist() == d['vals']
+    assert X[k - len(X)]['inds'].tolist() == d['inds']
+    assert decompress_vector(X[k], 30).tolist() == decompress_vector(d, 30)
+assert [row['inds'].tolist() for row in X] == [d['inds'] for d in dicts]
+
+# Rows and slices are views, not copies
+assert np.shares_memory(X[3]['vals'], X.vals) and not X[3]['vals'].flags.owndata
+for start, stop in [(0, 51), (10, 20), (20, 10), (-5, None), (50, 51)]:
+    Y = X[start:stop]
+    assert np.shares_memory(Y.indptr, X.indptr) and Y.inds is X.inds and Y.vals is X.vals
+    assert [row['inds'].tolist() for row in Y] == [d['inds'] for d in dicts[start:stop]]
+
+# Matrix-vector products: one dot product per row, summed in storage order
+x = np.random.random(30)
+y = X.matvec(x)
+assert y.tolist() == [sum([v * x[i] for i, v in zip(d['inds'], d['vals'])], 0.0) for d in dicts]
+X_dense = np.array([decompress_vector(d, 30) for d in dicts])
+assert np.allclose(y, X_dense.dot(x))
+assert X[10:20].matvec(x).tolist() == y[10:20].tolist() and len(X[20:10].matvec(x)) == 0
+assert len(CompressedVectors.from_dicts([]).matvec(np.zeros(0))) == 0
+
+dicts = [compress_vector(np.where(np.random.random(1000) <= 0.01, np.random.random(1000), 0.0)) for _ in range(1000)]
+assert CompressedVectors.from_dicts(dicts)[7]['inds'].tolist() == dicts[7]['inds'].tolist()
+
+# Bigger: 100,000 users with about 10 entries each
+big_dicts = [{'inds': sample(range(10000), 10), 'vals': [random() for _ in range(10)]} for _ in range(100000)]
+X = CompressedVectors.from_dicts(big_dicts, 10000)
+x = np.random.random(10000)
+print("Bytes: {:,} as dictionaries versus {:,} packed".format(
+      sum(getsizeof(d) + sum(getsizeof(L) + sum(map(getsizeof, L)) for L in d.values()) for d in big_dicts), X.nbytes))
+get_ipython().magic('timeit -n 1 -r 1 [sum([v * x[i] for i, v in zip(d["inds"], d["vals"])]) for d in big_dicts]')
+get_ipython().magic('timeit X.matvec(x)')
+
+print("\n(Passed!)")
+
+
+# **Aside: common indices of many vectors.** The `find_common_inds` function from Exercise 4 builds a set from _each_ of its inputs, so it takes time proportional to their total size, and it handles only two vectors. When the indices are sorted, as they are in canonical form, we can do much better with many vectors of very different sizes.
+# 
+# Take the shortest index array and, for each of its indices `x`, look for `x` in each of the other arrays. Since the candidates only increase, each search can start where the previous one in the same array stopped. Moreover, instead of scanning forward, we can _gallop_: probe positions 1, 2, 4, 8, ... ahead until passing `x`, and then binary-search the last gap. Finding an entry `d` positions ahead this way takes about $2 \log_2 d$ steps. And if an array does not contain `x`, the next entry it does contain is a lower bound for the next candidate, so we may gallop ahead in the shortest array, too.
+# 
+# In all, the cost is roughly (length of the shortest array) $\times$ (number of arrays) $\times$ (logarithm of the gaps), no matter how long the other arrays are. The function `intersect_sorted_inds` implements this for any sorted sequences, such as lists or the arrays of a `SparseVector`, and `find_common_inds_many` applies it to the canonical forms of a list of `SparseVector` objects.
+
+# In[ ]:
+
+
+from bisect import bisect_left
+
+def gallop(a, x, lo=0):
+    """
+    Returns the first position `p >= lo` in the sorted sequence `a` such
+    that `a[p] >= x`, or `len(a)` if there is none.
+    """
+    step, hi = 1, lo
+    while hi < len(a) and a[hi] < x:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(a, x, lo, min(hi, len(a)))
+
+def intersect_sorted_inds(arrays):
+    """
+    Returns a sorted list of the values common to all of the given sorted
+    sequences, without duplicates.
+    """
+    if not arrays:
+        return []
+    smallest, *others = sorted(arrays, key=len)
+    pos = [0] * len(others)
+    common = []
+    k = 0
+    while k < len(smallest):
+        x = smallest[k]
+        for j, a in enumerate(others):
+            pos[j] = gallop(a, x, pos[j])
+            if pos[j] == len(a):
+                return common
+            if a[pos[j]] != x:
+                k = gallop(smallest, a[pos[j]], k+1)
+                break
+        else:
+            common.append(x)
+            while k < len(smallest) and smallest[k] == x:
+                k += 1
+    return common
+
+def find_common_inds_many(vectors):
+    """Returns the indices common to all of the given `SparseVector` objects."""
+    return intersect_sorted_inds([v.canonical().inds for v in vectors])
+
+# Demo:
+print(intersect_sorted_inds([[1, 3, 5, 7, 9, 11], [1, 1, 2, 3, 5, 8, 13], list(range(0, 100, 3)) + [100]]))
+
+
+# In[ ]:
+
+
+# `intersect_sorted_inds_test`: Test cell
+def check_intersect_sorted_inds(arrays):
+    common = intersect_sorted_inds(arrays)
+    assert common == (sorted(set.intersection(*map(set, arrays))) if arrays else [])
+
+assert gallop([1, 3, 5, 7], 0) == 0 and gallop([1, 3, 5, 7], 4) == 2 and gallop([1, 3, 5, 7], 8) == 4
+assert gallop([1, 3, 5, 7], 1, 2) == 2 and gallop([], 5) == 0
+for _ in range(100):
+    a = sorted(randrange(100) for _ in range(randrange(30)))
+    x, lo = randrange(-5, 105), randrange(len(a) + 1)
+    assert gallop(a, x, lo) == max(bisect_left(a, x), lo)
+
+check_intersect_sorted_inds([])
+check_intersect_sorted_inds([[2, 3, 3]])
+check_intersect_sorted_inds([[1, 1, 2, 2, 3], [1, 2, 2, 2]])
+check_intersect_sorted_inds([[], [1, 2, 3]])
+check_intersect_sorted_inds([[1, 2, 3], [4, 5, 6]])
+for _ in range(200):
+    k = randrange(1, 8)
+    arrays = [sorted(randrange(500) for _ in range(int(500 * random() ** 3))) for _ in range(k)]
+    if random() < 0.3: # a common core, so that the answer is rarely empty
+        core = sample(range(500), 20)
+        arrays = [sorted(a + core) for a in arrays]
+    check_intersect_sorted_inds(arrays)
+    check_intersect_sorted_inds([array('q', a) for a in arrays])
+
+d1 = {'inds': [9, 9, 1, 9, 8, 1], 'vals': [0.28, 0.84, 0.71, 0.03, 0.04, 0.75]}
+d2 = {'inds': [0, 9, 9, 1, 3, 3, 9], 'vals': [0.26, 0.06, 0.46, 0.58, 0.42, 0.21, 0.53]}
+assert find_common_inds_many([SparseVector.from_dict(d1), SparseVector.from_dict(d2, 10)]) == [1, 9]
+
+# Dozens of vectors of very different densities: the cost follows the sparsest one
+n_big = 1000000
+big_arrays = [sorted(sample(range(n_big), 10))]
+big_arrays += [sorted(set(big_arrays[0]) | set(sample(range(n_big), int(n_big * p)))) for p in [0.05, 0.1, 0.2, 0.5] * 8]
+assert intersect_sorted_inds(big_arrays) == big_arrays[0]
+big_dicts = [{'inds': a, 'vals': [1.0] * len(a)} for a in big_arrays]
+get_ipython().magic('timeit -n 1 -r 1 set.intersection(*(set(d["inds"]) for d in big_dicts))')
+get_ipython().magic('timeit intersect_sorted_inds(big_arrays)')
+
+print("\n(Passed!)")
+
+
 # In[ ]:
 
 
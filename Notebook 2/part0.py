@@ -322,17 +322,11 @@ def filter_rules_by_conf (pair_counts, item_counts, threshold, count = None):
            if item_counts[key[0]]:
                if pair_counts[key]/item_counts[key[0]] >= threshold:
                    rules[key] = pair_counts[key]/item_counts[key[0]]
-           elif item_counts[key[1]]:
-               if pair_counts[key]/item_counts[key[1]] >= threshold:
-                   rules[key] = pair_counts[key]/item_counts[key[1]]
    else:
        for key in pair_counts.keys():
            if item_counts[key[0]] and item_counts[key[0]] >= count:
                if pair_counts[key]/item_counts[key[0]] >= threshold:
                    rules[key] = pair_counts[key]/item_counts[key[0]]
-           elif item_counts[key[1]] and item_counts[key[1]] >= count:
-               if pair_counts[key]/item_counts[key[1]] >= threshold:
-                   rules[key] = pair_counts[key]/item_counts[key[1]]
            
                
    return rules
@@ -640,3 +634,2779 @@ for k in ans_keys:
 
 print("\n(Passed!)")
 
+
+
+# ## Scaling up: an integer-encoded backend
+# 
+# The dictionary-based implementation above does a little bit of interpreter work for _every_ ordered pair in _every_ basket. On the groceries data that is fine, but on a real volume of receipts that per-pair work is the entire runtime.
+# 
+# A different way to look at the same computation is through linear algebra. Suppose we give each distinct item a dense integer id, $0, 1, \ldots, m-1$, and build the $n \times m$ _incidence matrix_ $X$, where $x_{ri} = 1$ if receipt $r$ contains item $i$ and $0$ otherwise. Then:
+# 
+# - the count of item $i$ is the $i$-th column sum of $X$; and
+# - the count of the pair $(i, j)$ is the $(i, j)$ entry of $X^T X$.
+# 
+# Since $X$ is very sparse, we can store it in the compressed sparse row (CSR) format of `scipy.sparse`, in which case $X^T X$ is a single sparse matrix product. The functions below implement this idea; `find_assoc_rules` then takes a `backend` argument that selects between the original dictionaries (`'dict'`) and the sparse product (`'sparse'`). Either way, it returns the same `(a, b) -> conf` dictionary.
+# 
+# > Receipts are treated as sets, so an item repeated within one receipt is counted once.
+
+# In[ ]:
+
+
+import numpy as np
+from scipy import sparse
+
+def encode_receipts(receipts, item_ids=None):
+    """
+    Assigns a dense integer id to every distinct item in `receipts`.
+    Returns the list of items, indexed by id, and the receipt-by-item
+    incidence matrix as a `scipy.sparse` CSR matrix.
+
+    If given, `item_ids` is an existing item -> id dictionary, which is
+    reused and extended in-place with any new items.
+    """
+    if item_ids is None and hasattr(receipts, 'incidence_matrix'):
+        return receipts.items, receipts.incidence_matrix() # Already encoded (see `Baskets`, below)
+    if item_ids is None:
+        item_ids = {}
+    indices = []
+    indptr = [0]
+    for receipt in receipts:
+        for item in receipt:
+            indices.append(item_ids.setdefault(item, len(item_ids)))
+        indptr.append(len(indices))
+    items = list(item_ids)
+    X = sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+                          shape=(len(indptr)-1, len(items)))
+    X.sum_duplicates()
+    X.data[:] = 1 # Receipts are sets
+    return items, X
+
+def count_items_and_pairs(X):
+    """
+    Given an incidence matrix `X`, returns the item counts (column sums)
+    and the pair counts, X^T X with its diagonal removed.
+    """
+    item_counts = np.asarray(X.sum(axis=0)).ravel()
+    pair_counts = (X.T @ X).tocsr()
+    pair_counts.setdiag(0)
+    pair_counts.eliminate_zeros()
+    return item_counts, pair_counts
+
+def filter_rules_by_conf_sparse(items, item_counts, pair_counts, threshold, count=None):
+    """
+    Same as `filter_rules_by_conf`, but for the array-based tables
+    produced by `count_items_and_pairs`.
+    """
+    C = pair_counts.tocoo()
+    a, b = C.row, C.col
+    conf = C.data / item_counts[a]
+    keep = conf >= threshold
+    if count is not None:
+        keep &= item_counts[a] >= count
+    return {(items[i], items[j]): conf_ab
+            for i, j, conf_ab in zip(a[keep].tolist(), b[keep].tolist(), conf[keep].tolist())}
+
+def find_assoc_rules_sparse(receipts, threshold, count=None):
+    items, X = encode_receipts(receipts)
+    item_counts, pair_counts = count_items_and_pairs(X)
+    return filter_rules_by_conf_sparse(items, item_counts, pair_counts, threshold, count)
+
+def find_assoc_rules_dict(receipts, threshold, count=None):
+    """The original, dictionary-based `find_assoc_rules`, above."""
+    pair_counts = defaultdict(int)
+    item_counts = defaultdict(int)
+    for rep in receipts:
+        update_pair_counts(pair_counts, rep)
+        update_item_counts(item_counts, rep)
+    return filter_rules_by_conf(pair_counts, item_counts, threshold, count)
+
+# Counting backends for `find_assoc_rules`, by name
+ASSOC_RULE_BACKENDS = {'dict': find_assoc_rules_dict,
+                       'sparse': find_assoc_rules_sparse}
+
+def find_assoc_rules(receipts, threshold, count=None, backend='dict', **options):
+    """
+    Mines pairwise rules using the named counting backend. Any extra
+    keyword `options` are passed through to the backend.
+    """
+    assert backend in ASSOC_RULE_BACKENDS, "Unknown backend: {}".format(backend)
+    return ASSOC_RULE_BACKENDS[backend](receipts, threshold, count, **options)
+
+# Demo:
+items, X = encode_receipts([set('abbc'), set('ac'), set('a')])
+print("Items:", items)
+print("Incidence matrix:\n", X.toarray())
+print_rules(find_assoc_rules([set('abbc'), set('ac'), set('a')], 0.6, backend='sparse'))
+
+
+# In[ ]:
+
+
+# `find_assoc_rules_sparse_test`: Test cell
+def check_same_rules(rules, rules_true):
+    assert type(rules) is dict
+    assert rules.keys() == rules_true.keys(), "Rule sets differ."
+    for key in rules_true:
+        assert rules[key] == rules_true[key], "conf({} => {}) differs".format(*key)
+
+check_same_rules(find_assoc_rules(norm_latin_itemsets, 0.75, backend='sparse'), latin_rules)
+check_same_rules(find_assoc_rules(norm_english_itemsets, 0.75, backend='sparse'), english_rules)
+check_same_rules(find_assoc_rules(l, THRESHOLD, MIN_COUNT, backend='sparse'), basket_rules)
+check_same_rules(find_assoc_rules(l, 0.1, backend='sparse'), find_assoc_rules(l, 0.1))
+assert ASSOC_RULE_BACKENDS['dict'] is find_assoc_rules_dict # not the wrapper, even if this cell is re-run
+
+print("\n(Passed!)")
+
+
+# How much faster is it? Here is the groceries data, counted both ways:
+
+# In[ ]:
+
+
+get_ipython().magic('timeit find_assoc_rules(l, THRESHOLD, MIN_COUNT)')
+get_ipython().magic("timeit find_assoc_rules(l, THRESHOLD, MIN_COUNT, backend='sparse')")
+
+
+# ## Storing each pair only once
+# 
+# The table built by `update_pair_counts` is symmetric: it holds both $(a, b)$ and $(b, a)$, always with the same count, and every entry is a separate tuple key in a dictionary. That is twice the entries we need, each with a lot of per-object overhead.
+# 
+# The class below, `SymmetricPairCounts`, stores each unordered pair exactly once. Given item ids $i < j$ out of $m$ items, it packs the pair into the single integer key $i \cdot m + j$, and keeps a sorted array of those keys alongside an array of counts. Looking up a pair is then a binary search.
+# 
+# It also behaves like a read-only dictionary: `pair_counts[(a, b)]` and `pair_counts[(b, a)]` return the same count, and iterating over it yields both orderings. Therefore, it can be passed directly to `filter_rules_by_conf`, which will see rules in either direction. However, that does a separate binary search for every lookup, which is much slower than a dictionary. The intended way to read the rules is the method `filter_rules`, which computes the confidences of all pairs, in both directions, at once from the packed arrays.
+
+# In[ ]:
+
+
+from collections.abc import Mapping
+from sys import getsizeof
+
+class SymmetricPairCounts(Mapping):
+    """
+    Read-only table of pair counts that stores each unordered pair
+    once, as a sorted array of packed keys i*m + j (i < j) plus an
+    array of counts.
+    """
+    def __init__(self, items, keys, counts):
+        self.vocab = list(items)
+        self.item_ids = {item: i for i, item in enumerate(self.vocab)}
+        self.keys_packed = np.asarray(keys, dtype=np.int64)
+        self.counts = np.asarray(counts)
+        assert len(self.keys_packed) == len(self.counts)
+
+    @classmethod
+    def from_matrix(cls, items, pair_counts):
+        """Builds the table from the upper triangle of a sparse pair-count matrix."""
+        m = len(items)
+        U = sparse.triu(pair_counts, k=1).tocoo()
+        keys = U.row.astype(np.int64) * m + U.col
+        order = np.argsort(keys)
+        return cls(items, keys[order], U.data[order])
+
+    @classmethod
+    def from_receipts(cls, receipts):
+        items, X = encode_receipts(receipts)
+        _, pair_counts = count_items_and_pairs(X)
+        return cls.from_matrix(items, pair_counts)
+
+    @classmethod
+    def from_dict(cls, pair_counts):
+        """Builds the table from a (symmetric) dictionary of pair counts."""
+        items = list(dict.fromkeys(a for a, _ in pair_counts))
+        item_ids = {item: i for i, item in enumerate(items)}
+        m = len(items)
+        keys, counts = [], []
+        for (a, b), n_ab in pair_counts.items():
+            i, j = item_ids[a], item_ids[b]
+            if i < j:
+                keys.append(i*m + j)
+                counts.append(n_ab)
+        keys = np.array(keys, dtype=np.int64)
+        order = np.argsort(keys)
+        return cls(items, keys[order], np.array(counts, dtype=np.int32)[order])
+
+    def _find(self, key):
+        a, b = key
+        i, j = self.item_ids.get(a), self.item_ids.get(b)
+        if i is None or j is None or i == j:
+            return -1
+        if i > j:
+            i, j = j, i
+        k = i*len(self.vocab) + j
+        pos = np.searchsorted(self.keys_packed, k)
+        if pos < len(self.keys_packed) and self.keys_packed[pos] == k:
+            return pos
+        return -1
+
+    def __getitem__(self, key):
+        pos = self._find(key)
+        if pos < 0:
+            raise KeyError(key)
+        return int(self.counts[pos])
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        m = len(self.vocab)
+        for k in self.keys_packed.tolist():
+            i, j = divmod(k, m)
+            yield (self.vocab[i], self.vocab[j])
+            yield (self.vocab[j], self.vocab[i])
+
+    def __len__(self):
+        return 2 * len(self.keys_packed)
+
+    def filter_rules(self, item_counts, threshold, count=None):
+        """
+        Same as `filter_rules_by_conf`, where `item_counts` is either a
+        dictionary or an array indexed by item id.
+        """
+        if not isinstance(item_counts, np.ndarray):
+            item_counts = np.array([item_counts[item] for item in self.vocab], dtype=np.int64)
+        m = len(self.vocab)
+        i, j = np.divmod(self.keys_packed, m)
+        n_ij = self.counts
+        both = sparse.coo_matrix((np.concatenate([n_ij, n_ij]), (np.concatenate([i, j]), np.concatenate([j, i]))),
+                                 shape=(m, m))
+        return filter_rules_by_conf_sparse(self.vocab, item_counts, both, threshold, count)
+
+    @property
+    def nbytes(self):
+        """Bytes held by the table, including its item list and index."""
+        return (self.keys_packed.nbytes + self.counts.nbytes
+                + getsizeof(self.vocab) + sum(getsizeof(item) for item in self.vocab)
+                + getsizeof(self.item_ids))
+
+# Demo:
+half_counts = SymmetricPairCounts.from_receipts([set('abbc'), set('ac'), set('a')])
+print("Stored pairs:", len(half_counts.keys_packed), "\nAs a dictionary:", dict(half_counts))
+print("('a', 'c') =>", half_counts[('a', 'c')], "; ('c', 'a') =>", half_counts[('c', 'a')])
+
+
+# In[ ]:
+
+
+# `symmetric_pair_counts_test`: Test cell
+from sys import getsizeof
+
+half_counts = SymmetricPairCounts.from_receipts(l)
+assert dict(half_counts) == dict(pair_counts)
+assert len(half_counts.keys_packed) * 2 == len(pair_counts)
+assert all(np.diff(half_counts.keys_packed) > 0)
+assert SymmetricPairCounts.from_dict(pair_counts) == half_counts
+assert ('whole milk', 'no such item') not in half_counts
+
+check_same_rules(filter_rules_by_conf(half_counts, item_counts, THRESHOLD, MIN_COUNT), basket_rules)
+check_same_rules(half_counts.filter_rules(item_counts, THRESHOLD, MIN_COUNT), basket_rules)
+half_item_counts = np.array([item_counts[item] for item in half_counts.vocab])
+for threshold, count in [(0.0, None), (0.2, None), (0.3, 100)]:
+    check_same_rules(half_counts.filter_rules(half_item_counts, threshold, count),
+                     filter_rules_by_conf(pair_counts, item_counts, threshold, count))
+check_same_rules(SymmetricPairCounts.from_dict({}).filter_rules({}, 0.0), {})
+
+get_ipython().magic('timeit filter_rules_by_conf(pair_counts, item_counts, THRESHOLD, MIN_COUNT)')
+get_ipython().magic('timeit half_counts.filter_rules(half_item_counts, THRESHOLD, MIN_COUNT)')
+
+dict_bytes = getsizeof(pair_counts) + sum(getsizeof(key) for key in pair_counts)
+print("Dictionary of pair counts: ~{:,} bytes".format(dict_bytes))
+print("Half storage:               {:,} bytes".format(half_counts.nbytes))
+assert half_counts.nbytes < dict_bytes / 2
+
+print("\n(Passed!)")
+
+
+# ## Streaming baskets from a file
+# 
+# In Exercise 11, we pulled the entire groceries file into memory as one string and then split it into a list of lists before counting anything. For a multi-gigabyte log of receipts, the input itself would not fit.
+# 
+# But notice that the algorithm never needs to see all receipts at once: it only needs the _count tables_. So we can read the baskets in fixed-size chunks, update the tables, and throw each chunk away. The function `find_assoc_rules_streaming` does exactly that. Its `source` may be a file path or any iterable of lines (e.g., an open file), and memory stays bounded by the size of the count tables rather than by the size of the input.
+# 
+# Blank lines, including the one that follows the final newline of a file, are skipped instead of being counted as an empty basket.
+
+# In[ ]:
+
+
+from itertools import islice
+
+def iter_baskets(source, sep=','):
+    """
+    Yields each non-blank line of `source`, a file path or an iterable
+    of lines, as a list of items.
+    """
+    if type(source) is str:
+        with open(source) as f:
+            yield from iter_baskets(f, sep)
+        return
+    for line in source:
+        line = line.rstrip('\r\n')
+        if line:
+            yield line.split(sep)
+
+def iter_chunks(iterable, chunk_size):
+    """Yields successive lists of (at most) `chunk_size` elements of `iterable`."""
+    it = iter(iterable)
+    chunk = list(islice(it, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, chunk_size))
+
+def find_assoc_rules_streaming(source, threshold, count=None, chunk_size=10000, backend='dict'):
+    assert backend in ('dict', 'sparse'), "Unknown backend: {}".format(backend)
+    if backend == 'dict':
+        pair_counts = defaultdict(int)
+        item_counts = defaultdict(int)
+        for chunk in iter_chunks(iter_baskets(source), chunk_size):
+            for rep in chunk:
+                update_pair_counts(pair_counts, rep)
+                update_item_counts(item_counts, rep)
+        return filter_rules_by_conf(pair_counts, item_counts, threshold, count)
+
+    item_ids = {}
+    item_counts = np.zeros(0, dtype=np.int64)
+    pair_counts = sparse.csr_matrix((0, 0), dtype=np.int64)
+    for chunk in iter_chunks(iter_baskets(source), chunk_size):
+        items, X = encode_receipts(chunk, item_ids)
+        chunk_item_counts, chunk_pair_counts = count_items_and_pairs(X)
+        m = len(items)
+        item_counts = np.pad(item_counts, (0, m - len(item_counts))) + chunk_item_counts
+        pair_counts.resize((m, m))
+        pair_counts = pair_counts + chunk_pair_counts
+    return filter_rules_by_conf_sparse(list(item_ids), item_counts, pair_counts, threshold, count)
+
+# Demo:
+import os
+from tempfile import TemporaryDirectory
+
+# Scratch space for the files this notebook writes; it is deleted when the kernel exits
+scratch_dir = TemporaryDirectory()
+
+def scratch_path(name):
+    return os.path.join(scratch_dir.name, name)
+
+groceries_path = scratch_path('groceries.csv')
+with open(groceries_path, 'w') as f:
+    f.write(groceries_file)
+print("First three baskets:", list(islice(iter_baskets(groceries_path), 3)))
+
+
+# In[ ]:
+
+
+# `find_assoc_rules_streaming_test`: Test cell
+from io import StringIO
+
+for backend in ['dict', 'sparse']:
+    for chunk_size in [1, 500, 100000]:
+        rules = find_assoc_rules_streaming(groceries_path, THRESHOLD, MIN_COUNT, chunk_size, backend)
+        check_same_rules(rules, basket_rules)
+    rules = find_assoc_rules_streaming(StringIO(groceries_file), 0.1, chunk_size=700, backend=backend)
+    check_same_rules(rules, find_assoc_rules(l, 0.1))
+
+assert len(list(iter_baskets(["a,b\n", "\n", "c\r\n"]))) == 2
+assert list(iter_chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+print("\n(Passed!)")
+
+
+# ## Counting in parallel
+# 
+# All of the counting so far runs on a single core. However, counting is easy to split up: if we divide the receipts into _shards_, count each shard separately, and then add the resulting tables together, we get exactly the same tables as if we had counted everything at once. Moreover, adding tables is associative, so the shard tables may be merged in any grouping as they finish.
+# 
+# The function `count_receipts` builds the local item and pair tables for one shard, `merge_counts` adds one pair of tables into another, and `find_assoc_rules_parallel` farms the shards out to a `multiprocessing` pool. It is also available as `find_assoc_rules(..., backend='parallel', processes=...)`.
+# 
+# One caveat: a pool worker finds the function it should run, here `count_receipts`, by its name in the `__main__` module. For a notebook, that only works if the workers are _forked_ from the notebook's process, and so inherit its functions. Workers started by _spawning_ a fresh interpreter, the default on Windows and macOS, cannot see them. So `notebook_pool_context` asks for forked workers where that is possible, and otherwise `find_assoc_rules_parallel` warns and counts serially.
+
+# In[ ]:
+
+
+from multiprocessing import cpu_count, get_all_start_methods, get_context
+from functools import reduce
+import sys
+import warnings
+
+def notebook_pool_context():
+    """
+    Returns a `multiprocessing` context whose pools can run functions
+    defined in this notebook, i.e., one that forks its workers, or
+    `None` if forking is unavailable or unsafe on this platform.
+    """
+    if sys.platform != 'darwin' and 'fork' in get_all_start_methods():
+        return get_context('fork')
+    return None
+
+def count_receipts(receipts):
+    """
+    Returns new tables of item counts and pair counts for the given
+    receipts, as a tuple `(item_counts, pair_counts)`.
+    """
+    item_counts = defaultdict(int)
+    pair_counts = defaultdict(int)
+    for rep in receipts:
+        update_pair_counts(pair_counts, rep)
+        update_item_counts(item_counts, rep)
+    return item_counts, pair_counts
+
+def merge_counts(tables, other):
+    """
+    Adds the count tables `other` into `tables`, in-place, and returns
+    `tables`. Both are `(item_counts, pair_counts)` tuples.
+    """
+    for table, other_table in zip(tables, other):
+        for key, n in other_table.items():
+            table[key] += n
+    return tables
+
+def split_shards(receipts, num_shards):
+    """Splits a list of receipts into `num_shards` contiguous shards."""
+    size = -(-len(receipts) // num_shards) if receipts else 1
+    return [receipts[k:k+size] for k in range(0, len(receipts), size)]
+
+def find_assoc_rules_parallel(receipts, threshold, count=None, processes=None, shards_per_process=4):
+    if processes is None:
+        processes = cpu_count()
+    context = notebook_pool_context()
+    if context is None:
+        warnings.warn("Pool workers cannot run notebook functions on this platform; counting serially",
+                      RuntimeWarning)
+        item_counts, pair_counts = count_receipts(receipts)
+        return filter_rules_by_conf(pair_counts, item_counts, threshold, count)
+    shards = split_shards(list(receipts), processes * shards_per_process)
+    with context.Pool(processes) as pool:
+        tables = reduce(merge_counts, pool.imap_unordered(count_receipts, shards),
+                        (defaultdict(int), defaultdict(int)))
+    item_counts, pair_counts = tables
+    return filter_rules_by_conf(pair_counts, item_counts, threshold, count)
+
+ASSOC_RULE_BACKENDS['parallel'] = find_assoc_rules_parallel
+
+# Demo:
+print_rules(find_assoc_rules([set('abbc'), set('ac'), set('a')], 0.6, backend='parallel', processes=2))
+
+
+# In[ ]:
+
+
+# `find_assoc_rules_parallel_test`: Test cell
+shard_tables = [count_receipts(shard) for shard in split_shards(l, 7)]
+left = reduce(merge_counts, shard_tables[:4], (defaultdict(int), defaultdict(int)))
+right = reduce(merge_counts, shard_tables[4:], (defaultdict(int), defaultdict(int)))
+merged = merge_counts(left, right)
+assert merged[0] == item_counts and merged[1] == pair_counts
+
+for processes in [1, 2, 3]:
+    check_same_rules(find_assoc_rules(l, THRESHOLD, MIN_COUNT, backend='parallel', processes=processes),
+                     basket_rules)
+check_same_rules(find_assoc_rules(norm_latin_itemsets, 0.75, backend='parallel', processes=2), latin_rules)
+
+# Where workers cannot be forked, it warns and counts serially instead of hanging
+fork_context, notebook_pool_context = notebook_pool_context, lambda: None
+try:
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        check_same_rules(find_assoc_rules(l, THRESHOLD, MIN_COUNT, backend='parallel', processes=2), basket_rules)
+    assert [w.category for w in caught] == [RuntimeWarning]
+finally:
+    notebook_pool_context = fork_context
+
+print("\n(Passed!)")
+
+
+# **Benchmark: scaling with the number of cores.** Here is a synthetic workload, made by `gen_synthetic_baskets`: baskets of about 10 items on average, drawn from a vocabulary of 1,000 items, where item $i$ is picked with probability proportional to $1/(i+1)^s$ (a _Zipf_ distribution, here with $s=1$). How does the running time change as we add processes? (Your results will depend on how many cores your machine has.)
+
+# In[ ]:
+
+
+def gen_synthetic_baskets(num_baskets, num_items=1000, mean_len=10, zipf_s=1.0, seed=6040):
+    """
+    Returns a list of `num_baskets` random baskets (sets) over the items
+    'item0', 'item1', ..., where item i is drawn with probability
+    proportional to 1/(i+1)**zipf_s. Each basket makes 1 + Poisson(mean_len-1)
+    draws, so a few items may repeat and collapse into one.
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, num_items+1) ** zipf_s
+    sizes = 1 + rng.poisson(mean_len - 1, num_baskets)
+    draws = rng.choice(num_items, size=sizes.sum(), p=weights / weights.sum())
+    vocab = np.array(['item{}'.format(i) for i in range(num_items)], dtype=object)
+    return [set(basket) for basket in np.split(vocab[draws], np.cumsum(sizes)[:-1])]
+
+synthetic_baskets = gen_synthetic_baskets(20000)
+check_same_rules(find_assoc_rules(synthetic_baskets, 0.5, 10, backend='parallel', processes=2),
+                 find_assoc_rules(synthetic_baskets, 0.5, 10))
+
+t_serial = get_ipython().magic('timeit -q -o -n 1 -r 3 find_assoc_rules(synthetic_baskets, 0.5, 10)')
+print("serial: {:.3f} s".format(t_serial.best))
+for processes in sorted({1, 2, 4, cpu_count()}):
+    t = get_ipython().magic("timeit -q -o -n 1 -r 3 find_assoc_rules(synthetic_baskets, 0.5, 10, backend='parallel', processes=processes)")
+    print("{} process(es): {:.3f} s (speedup: {:.2f}x)".format(processes, t.best, t_serial.best / t.best))
+
+
+# ## Pruning rare items before counting pairs
+# 
+# So far, `MIN_COUNT` is only applied inside `filter_rules_by_conf`, that is, _after_ every pair in every basket has been counted, including the many pairs that involve items too rare to ever appear in a rule. On long receipts full of rare items, those pairs are most of the quadratic work.
+# 
+# How rare is "too rare"? Suppose $a \Rightarrow b$ is a rule that survives the filter. Then $\mathrm{count}(a) \geq$ `count` and
+# 
+# $$\mathrm{count}(b) \geq \mathrm{count}(a, b) = \mathrm{conf}(a \Rightarrow b) \cdot \mathrm{count}(a) \geq \mathrm{threshold} \cdot \mathrm{count}.$$
+# 
+# So any item occurring fewer than $\min(\mathrm{count}, \mathrm{threshold} \cdot \mathrm{count})$ times can be dropped from every receipt without changing the result. Moreover, dropping them does not change the count of any item we keep, nor the count of any pair of kept items.
+# 
+# The updated `find_assoc_rules` below uses this fact whenever a minimum count is given: it makes one cheap pass to count items, prunes the receipts down to the frequent items, and only then hands them to the chosen backend to enumerate pairs. (Pass `prune=False` to skip this step.)
+
+# In[ ]:
+
+
+def min_item_count(threshold, count):
+    """
+    Returns the smallest item count that can appear in a rule a => b
+    with count(a) >= count and conf(a => b) >= threshold.
+    """
+    return min(count, threshold * count)
+
+def prune_receipts(receipts, threshold, count):
+    """
+    Returns the receipts restricted to the items that can take part in
+    a rule; receipts left with no items are dropped.
+    """
+    if hasattr(receipts, 'select_items'): # Already encoded (see `Baskets`, below)
+        return receipts.select_items(receipts.item_counts() >= min_item_count(threshold, count))
+    receipts = list(receipts)
+    item_counts = defaultdict(int)
+    for rep in receipts:
+        update_item_counts(item_counts, rep)
+    min_count = min_item_count(threshold, count)
+    frequent = {item for item, n in item_counts.items() if n >= min_count}
+    pruned = []
+    for rep in receipts:
+        rep = [item for item in rep if item in frequent]
+        if rep:
+            pruned.append(rep)
+    return pruned
+
+def find_assoc_rules(receipts, threshold, count=None, backend='dict', prune=True, save_counts=None, **options):
+    """
+    Mines pairwise rules using the named counting backend. If a minimum
+    `count` is given and `prune` is set, items too rare to take part in
+    any rule are removed before pairs are enumerated. Any extra keyword
+    `options` are passed through to the backend.
+
+    If `save_counts` is a path, the full count tables of the (unpruned)
+    receipts are also saved there; see `save_count_tables`, below. This
+    does not change the result.
+    """
+    assert backend in ASSOC_RULE_BACKENDS, "Unknown backend: {}".format(backend)
+    if save_counts is not None:
+        if not hasattr(receipts, 'incidence_matrix'):
+            receipts = list(receipts) # Read them twice
+        items, X = encode_receipts(receipts)
+        save_count_tables(save_counts, items, *count_items_and_pairs(X))
+    if count is not None and prune:
+        receipts = prune_receipts(receipts, threshold, count)
+    return ASSOC_RULE_BACKENDS[backend](receipts, threshold, count, **options)
+
+# Demo:
+pruned_baskets = prune_receipts(l, THRESHOLD, MIN_COUNT)
+num_pairs = lambda receipts: sum(len(rep)*(len(rep)-1)//2 for rep in receipts)
+print("Item-pairs to enumerate: {:,} => {:,} after pruning".format(num_pairs(l), num_pairs(pruned_baskets)))
+
+
+# In[ ]:
+
+
+# `prune_receipts_test`: Test cell
+assert min_item_count(0.5, 10) == 5
+assert min_item_count(2.0, 10) == 10
+
+for backend in ['dict', 'sparse', 'parallel']:
+    check_same_rules(find_assoc_rules(l, THRESHOLD, MIN_COUNT, backend=backend), basket_rules)
+    check_same_rules(find_assoc_rules(synthetic_baskets, 0.3, 50, backend=backend),
+                     find_assoc_rules(synthetic_baskets, 0.3, 50, backend=backend, prune=False))
+check_same_rules(find_assoc_rules(l, 0.0, MIN_COUNT), find_assoc_rules(l, 0.0, MIN_COUNT, prune=False))
+
+receipts = [set('abc'), set('ab'), set('ad'), set('e')]
+assert [sorted(rep) for rep in prune_receipts(receipts, 1.0, 2)] == [['a', 'b'], ['a', 'b'], ['a']]
+
+print("\n(Passed!)")
+
+
+# ## Beyond pairs: Apriori
+# 
+# Everything so far mines _pairwise_ rules, $a \Rightarrow b$. More generally, we might want rules whose antecedent is a set of items, such as $\{a, c\} \Rightarrow b$, whose confidence is $\mathrm{count}(\{a, b, c\}) / \mathrm{count}(\{a, c\})$. Naively extending `combinations(itemset, 2)` to `combinations(itemset, k)` blows up quickly on long receipts.
+# 
+# The classic fix is the _Apriori_ principle: every subset of a frequent itemset must itself be frequent. So we can find frequent itemsets level by level. The candidates of size $k$ are built only by joining frequent itemsets of size $k-1$ that share their first $k-2$ items, and a candidate is discarded before counting if any of its $(k-1)$-subsets is infrequent.
+# 
+# What "frequent" means follows from the same argument as in the pruning step above: a rule $A \Rightarrow b$ with $\mathrm{count}(A) \geq$ `count` and confidence at least `threshold` has $\mathrm{count}(A \cup \{b\}) \geq \min(\mathrm{count}, \mathrm{threshold} \cdot \mathrm{count})$.
+# 
+# The rules come back in the same dictionary format as before. A single-item antecedent is the item itself, so that with `max_size=2` the result is identical to the pairwise miner; a larger antecedent is a tuple of items, e.g., `(('a', 'c'), 'b')`. The miner is available as `find_assoc_rules(..., backend='apriori', max_size=k)`.
+
+# In[ ]:
+
+
+from math import comb
+
+def gen_candidates(frequent, k):
+    """
+    Given the set of frequent (k-1)-itemsets, as sorted tuples, returns
+    the set of candidate k-itemsets whose (k-1)-subsets are all frequent.
+    """
+    by_prefix = defaultdict(list)
+    for itemset in frequent:
+        by_prefix[itemset[:-1]].append(itemset[-1])
+    candidates = set()
+    for prefix, lasts in by_prefix.items():
+        for x, y in combinations(sorted(lasts), 2):
+            c = prefix + (x, y)
+            if all(c[:i] + c[i+1:] in frequent for i in range(k-2)):
+                candidates.add(c)
+    return candidates
+
+def find_frequent_itemsets(receipts, min_support=1, max_size=None):
+    """
+    Returns a dictionary mapping every itemset that occurs in at least
+    `min_support` receipts, and has at most `max_size` items, to its
+    count. Itemsets are tuples of item ids, in increasing order, where
+    the ids are indices into the returned list of items.
+    """
+    items, X = encode_receipts(receipts)
+    item_counts = np.asarray(X.sum(axis=0)).ravel().tolist()
+    itemset_counts = {(i,): n for i, n in enumerate(item_counts) if n >= min_support}
+    baskets = [tuple(i for i in X.indices[X.indptr[r]:X.indptr[r+1]].tolist() if (i,) in itemset_counts)
+               for r in range(X.shape[0])]
+    frequent = set(itemset_counts)
+    k = 2
+    while frequent and (max_size is None or k <= max_size):
+        candidates = gen_candidates(frequent, k)
+        counts = defaultdict(int)
+        useful = set()
+        for c in candidates:
+            useful.update(c)
+        for basket in baskets:
+            basket = [i for i in basket if i in useful]
+            if len(basket) < k:
+                continue
+            if comb(len(basket), k) <= len(candidates):
+                for c in combinations(basket, k):
+                    if c in candidates:
+                        counts[c] += 1
+            else:
+                basket = set(basket)
+                for c in candidates:
+                    if basket.issuperset(c):
+                        counts[c] += 1
+        frequent = {c for c, n in counts.items() if n >= min_support}
+        itemset_counts.update((c, counts[c]) for c in frequent)
+        k += 1
+    return items, itemset_counts
+
+def rules_from_itemsets(items, itemset_counts, threshold, count=None):
+    """
+    Returns the rules A => b, for every frequent itemset A + {b}, whose
+    confidence is at least `threshold` and whose antecedent occurs at
+    least `count` times.
+    """
+    rules = {}
+    for itemset, n_ab in itemset_counts.items():
+        if len(itemset) < 2:
+            continue
+        for k, b in enumerate(itemset):
+            a = itemset[:k] + itemset[k+1:]
+            n_a = itemset_counts[a]
+            if count is not None and n_a < count:
+                continue
+            if n_ab / n_a >= threshold:
+                a = items[a[0]] if len(a) == 1 else tuple(items[i] for i in a)
+                rules[(a, items[b])] = n_ab / n_a
+    return rules
+
+def find_assoc_rules_apriori(receipts, threshold, count=None, max_size=2):
+    min_support = 1 if count is None else max(1, min_item_count(threshold, count))
+    items, itemset_counts = find_frequent_itemsets(receipts, min_support, max_size)
+    return rules_from_itemsets(items, itemset_counts, threshold, count)
+
+ASSOC_RULE_BACKENDS['apriori'] = find_assoc_rules_apriori
+
+# Demo:
+print_rules(find_assoc_rules([set('abc'), set('abc'), set('ab'), set('ac'), set('bc')], 0.6,
+                             backend='apriori', max_size=3))
+
+
+# In[ ]:
+
+
+# `find_assoc_rules_apriori_test`: Test cell
+check_same_rules(find_assoc_rules(norm_latin_itemsets, 0.75, backend='apriori'), latin_rules)
+check_same_rules(find_assoc_rules(l, THRESHOLD, MIN_COUNT, backend='apriori'), basket_rules)
+
+def naive_itemset_rules(receipts, threshold, count, max_size):
+    counts = defaultdict(int)
+    for rep in receipts:
+        for k in range(1, max_size+1):
+            for c in combinations(sorted(rep), k):
+                counts[frozenset(c)] += 1
+    rules = {}
+    for c, n_ab in counts.items():
+        for b in c if len(c) > 1 else []:
+            a = c - {b}
+            if counts[a] >= count and n_ab / counts[a] >= threshold:
+                rules[(a, b)] = n_ab / counts[a]
+    return rules
+
+for threshold, count in [(0.75, 1), (0.5, 10)]:
+    rules = find_assoc_rules(norm_latin_itemsets, threshold, count, backend='apriori', max_size=4)
+    rules_true = naive_itemset_rules(norm_latin_itemsets, threshold, count, 4)
+    as_sets = {(frozenset(a) if type(a) is tuple else frozenset([a]), b): v for (a, b), v in rules.items()}
+    assert as_sets == rules_true
+    assert any(type(a) is tuple for a, _ in rules)
+
+rules = find_assoc_rules(synthetic_baskets, 0.5, 100, backend='apriori', max_size=None)
+print("Synthetic baskets: {} rules, largest antecedent has {} items".format(
+      len(rules), max(len(a) if type(a) is tuple else 1 for a, _ in rules)))
+
+print("\n(Passed!)")
+
+
+# ## Keeping the rules up to date
+# 
+# Every call to `find_assoc_rules` recounts all of the receipts from scratch. If receipts arrive continuously, that is mostly wasted work: adding or removing a receipt only changes the counts of the items in it, and the pairs among them.
+# 
+# Furthermore, the confidence of $a \Rightarrow b$ depends only on $\mathrm{count}(a, b)$ and $\mathrm{count}(a)$, and any receipt that changes the former also contains $a$. So after an update, the only rules we need to re-check are those whose _antecedent_ appeared in one of the new or retracted receipts.
+# 
+# The class `AssocRuleMiner` keeps the item and pair tables alive between updates, along with, for every item $a$, the set of items it has been seen with. Its `add_receipts` and `remove_receipts` methods update the tables and then re-check just the affected antecedents, so that its `rules` attribute always matches what `find_assoc_rules` would return for the receipts currently held.
+
+# In[ ]:
+
+
+class AssocRuleMiner:
+    """
+    Maintains item and pair counts, and the rules they imply, as
+    receipts are added and removed.
+    """
+    def __init__(self, threshold, count=None, receipts=()):
+        self.threshold = threshold
+        self.count = count
+        self.item_counts = defaultdict(int)
+        self.pair_counts = defaultdict(int)
+        self.neighbors = defaultdict(set) # a -> {b : count(a, b) > 0}
+        self.rules = {}
+        self.add_receipts(receipts)
+
+    def add_receipts(self, receipts):
+        self._update(receipts, 1)
+
+    def remove_receipts(self, receipts):
+        self._update(receipts, -1)
+
+    def _update(self, receipts, delta):
+        for a in self._count(receipts, delta):
+            self._refresh(a)
+
+    def _count(self, receipts, delta):
+        """Updates the counts and returns the set of items affected."""
+        receipts = [set(rep) for rep in receipts]
+        if delta < 0:
+            self._check_removal(receipts)
+        changed = set()
+        for rep in receipts:
+            for a, b in combinations(rep, 2):
+                for key in [(a, b), (b, a)]:
+                    self.pair_counts[key] += delta
+                    if self.pair_counts[key] == 0: # Drop it right away, so memory follows the live pairs
+                        del self.pair_counts[key]
+                        self.rules.pop(key, None)
+                if delta > 0:
+                    self.neighbors[a].add(b)
+                    self.neighbors[b].add(a)
+                elif (a, b) not in self.pair_counts:
+                    self.neighbors[a].discard(b)
+                    self.neighbors[b].discard(a)
+            for a in rep:
+                self.item_counts[a] += delta
+                if self.item_counts[a] == 0:
+                    del self.item_counts[a]
+                    self.neighbors.pop(a, None)
+            changed.update(rep)
+        return changed
+
+    def _check_removal(self, receipts):
+        """
+        Raises `ValueError`, before any count changes, unless every item
+        and pair count stays non-negative after removing `receipts`.
+        """
+        removed_items, removed_pairs = count_receipts(receipts)
+        if any(self.item_counts.get(a, 0) < n for a, n in removed_items.items()) \
+           or any(self.pair_counts.get(ab, 0) < n for ab, n in removed_pairs.items()):
+            raise ValueError("Removed a receipt that was never added")
+
+    def _refresh(self, a):
+        """Re-checks every rule with antecedent `a`."""
+        n_a = self.item_counts.get(a, 0)
+        for b in self.neighbors.get(a, ()):
+            n_ab = self.pair_counts[(a, b)]
+            if (self.count is None or n_a >= self.count) and n_ab / n_a >= self.threshold:
+                self.rules[(a, b)] = n_ab / n_a
+            else:
+                self.rules.pop((a, b), None)
+
+# Demo:
+miner = AssocRuleMiner(0.6)
+miner.add_receipts([set('abbc'), set('ac'), set('a')])
+print_rules(miner.rules)
+print("... after removing 'a':")
+miner.remove_receipts([set('a')])
+print_rules(miner.rules)
+
+
+# In[ ]:
+
+
+# `assoc_rule_miner_test`: Test cell
+from random import Random
+
+rng = Random(1)
+miner = AssocRuleMiner(THRESHOLD, MIN_COUNT)
+held = []
+for step in range(30):
+    if held and rng.random() < 0.4:
+        removed = [held.pop(rng.randrange(len(held))) for _ in range(rng.randint(1, min(50, len(held))))]
+        miner.remove_receipts(removed)
+    else:
+        added = rng.sample(l, 200)
+        miner.add_receipts(added)
+        held.extend(added)
+    check_same_rules(miner.rules, find_assoc_rules(held, THRESHOLD, MIN_COUNT))
+    assert all(n > 0 for n in miner.pair_counts.values())
+
+# Removing receipts that were never added fails without changing anything
+tables = (dict(miner.item_counts), dict(miner.pair_counts), dict(miner.rules))
+for bad_batch in [[held[0], {'no such item'}], [held[0], held[0]] * len(held), [{'a'}, {'b'}, {'a', 'b'}]]:
+    try:
+        miner.remove_receipts(bad_batch)
+        assert False, "Expected a ValueError"
+    except ValueError:
+        pass
+    assert (dict(miner.item_counts), dict(miner.pair_counts), dict(miner.rules)) == tables
+
+miner.remove_receipts(list(held))
+assert not miner.rules and not miner.item_counts and not miner.pair_counts
+
+pair_miner = AssocRuleMiner(0.5, receipts=[{'a'}, {'b'}])
+try:
+    pair_miner.remove_receipts([{'a', 'b'}]) # the items are there, but the pair is not
+    assert False, "Expected a ValueError"
+except ValueError:
+    assert dict(pair_miner.item_counts) == {'a': 1, 'b': 1} and not pair_miner.pair_counts
+
+check_same_rules(AssocRuleMiner(THRESHOLD, MIN_COUNT, l).rules, basket_rules)
+
+print("\n(Passed!)")
+
+
+# ## An index for threshold sweeps
+# 
+# When exploring a dataset, an analyst may call `filter_rules_by_conf` over and over with different values of `threshold` and `count`. Each call scans the entire pair table and recomputes every confidence, even though the confidences never change.
+# 
+# The class `RuleIndex` does that work once. It computes the confidence of every candidate rule, sorts the rules by confidence, and stores the antecedent count of each alongside. A query for `threshold` is then a binary search (`np.searchsorted`) for the first rule whose confidence is at least `threshold`, followed by a slice to the end; a minimum `count` is a vectorized mask over just that slice.
+# 
+# The method `query` returns the same dictionary as `filter_rules_by_conf`; the method `num_rules` returns just the number of rules, which is what a threshold slider usually needs to display.
+
+# In[ ]:
+
+
+class RuleIndex:
+    """
+    All candidate rules, sorted by confidence, along with the count of
+    each rule's antecedent.
+    """
+    def __init__(self, keys, pair_counts, antecedent_counts):
+        conf = np.asarray(pair_counts) / np.asarray(antecedent_counts)
+        order = np.argsort(conf, kind='stable')
+        self.keys = [keys[k] for k in order.tolist()]
+        self.conf = conf[order]
+        self.support = np.asarray(antecedent_counts)[order]
+
+    @classmethod
+    def from_counts(cls, pair_counts, item_counts):
+        keys = list(pair_counts)
+        return cls(keys, [pair_counts[key] for key in keys], [item_counts[a] for a, _ in keys])
+
+    @classmethod
+    def from_receipts(cls, receipts):
+        items, X = encode_receipts(receipts)
+        item_counts, pair_counts = count_items_and_pairs(X)
+        C = pair_counts.tocoo()
+        keys = [(items[i], items[j]) for i, j in zip(C.row.tolist(), C.col.tolist())]
+        return cls(keys, C.data, item_counts[C.row])
+
+    def _select(self, threshold, count=None):
+        start = np.searchsorted(self.conf, threshold, side='left')
+        if count is None:
+            return slice(start, None)
+        return start + np.flatnonzero(self.support[start:] >= count)
+
+    def num_rules(self, threshold, count=None):
+        selected = self._select(threshold, count)
+        if type(selected) is slice:
+            return len(self.keys) - selected.start
+        return len(selected)
+
+    def query(self, threshold, count=None):
+        selected = self._select(threshold, count)
+        if type(selected) is slice:
+            return dict(zip(self.keys[selected], self.conf[selected].tolist()))
+        return {self.keys[k]: conf for k, conf in zip(selected.tolist(), self.conf[selected].tolist())}
+
+    def top(self, k, count=None):
+        """Returns the `k` highest-confidence rules, as `top_rules` does."""
+        top = []
+        for pos in range(len(self.keys)-1, -1, -1):
+            if len(top) == k:
+                break
+            if count is None or self.support[pos] >= count:
+                top.append((self.keys[pos], float(self.conf[pos])))
+        return top
+
+# Demo:
+basket_index = RuleIndex.from_counts(pair_counts, item_counts)
+for threshold in [0.2, 0.3, 0.4, 0.5]:
+    print("threshold={}, count={}: {} rules".format(threshold, MIN_COUNT, basket_index.num_rules(threshold, MIN_COUNT)))
+
+
+# In[ ]:
+
+
+# `rule_index_test`: Test cell
+latin_index = RuleIndex.from_receipts(norm_latin_itemsets)
+check_same_rules(latin_index.query(0.75), latin_rules)
+check_same_rules(basket_index.query(THRESHOLD, MIN_COUNT), basket_rules)
+check_same_rules(RuleIndex.from_receipts(l).query(THRESHOLD, MIN_COUNT), basket_rules)
+
+for threshold in [0.0, 0.1, 0.25, 0.5, 1.0, 1.5]:
+    for count in [None, 1, 5, 50]:
+        rules_true = filter_rules_by_conf(pair_counts, item_counts, threshold, count)
+        check_same_rules(basket_index.query(threshold, count), rules_true)
+        assert basket_index.num_rules(threshold, count) == len(rules_true)
+
+get_ipython().magic('timeit basket_index.num_rules(0.3, MIN_COUNT)')
+get_ipython().magic('timeit filter_rules_by_conf(pair_counts, item_counts, 0.3, MIN_COUNT)')
+
+print("\n(Passed!)")
+
+
+# ## Normalizing large corpora
+# 
+# `normalize_string` builds its output one character at a time with `new_s += c`, after making a full lowercase copy, and `get_normalized_words` then splits the result in yet another pass. That is fine for _lorem ipsum_, but not for hundreds of megabytes of text.
+# 
+# Python strings and bytes have a method, `translate`, that maps or deletes characters according to a table in a single pass of C code:
+# 
+# - For ASCII input, we can work on raw `bytes`: `bytes.translate` lowercases and deletes all non-alphabetic, non-space bytes in one go, at close to memory speed.
+# - For other text, `str.translate` takes a mapping from code points to replacements, where `None` means "delete." Since there are far too many code points to tabulate up front, the table below, `NORMALIZE_TABLE`, is a dictionary that fills itself in the first time it sees each code point.
+# 
+# The generator `iter_normalized_words` fuses normalization and tokenization. It reads its input in chunks, whether the input is a file path, an open file, or any bytes-like buffer such as an `mmap`, and yields the normalized words one at a time. A word split across two chunks is carried over and completed by the next one. It is carried over _raw_, and lowercased only once it is complete, since lowercasing can depend on the context: a Greek capital sigma, Σ, becomes a final ς only at the end of a word. Bytes are decoded as UTF-8, incrementally, whenever a chunk is not pure ASCII.
+
+# In[ ]:
+
+
+from codecs import getincrementaldecoder
+from string import ascii_lowercase, ascii_uppercase
+
+class NormalizeTable(dict):
+    """
+    `str.translate` table that deletes every character that is neither
+    alphabetic nor whitespace, filled in lazily by code point.
+    """
+    def __missing__(self, code):
+        c = chr(code)
+        self[code] = code if c.isalpha() or c.isspace() else None
+        return self[code]
+
+NORMALIZE_TABLE = NormalizeTable()
+ASCII_LOWER = bytes.maketrans(ascii_uppercase.encode(), ascii_lowercase.encode())
+ASCII_DELETE = bytes(code for code in range(128) if not (chr(code).isalpha() or chr(code).isspace()))
+
+def iter_raw_chunks(source, chunk_size):
+    """
+    Yields successive chunks of `source`: a file path, an open file, or
+    a bytes-like buffer (e.g., `bytes` or `mmap`).
+    """
+    if type(source) is str:
+        with open(source, 'rb') as f:
+            yield from iter_raw_chunks(f, chunk_size)
+    elif hasattr(source, 'read'):
+        chunk = source.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = source.read(chunk_size)
+    else:
+        for start in range(0, len(source), chunk_size):
+            yield bytes(source[start:start+chunk_size])
+
+def split_last_word(text):
+    """
+    Splits `text` (a `str` or `bytes`) into everything up to its last
+    word, and that word, if nothing follows it (i.e., it may continue).
+    """
+    if not text or text[-1:].isspace():
+        return text, text[:0]
+    parts = text.rsplit(None, 1)
+    last = parts.pop()
+    return (parts[0] if parts else text[:0]), last
+
+def iter_normalized_words(source, chunk_size=1 << 20):
+    """
+    Yields the words of `source`, normalized as by `normalize_string`.
+    See `iter_raw_chunks` for the kinds of `source` accepted.
+    """
+    decoder = getincrementaldecoder('utf-8')()
+    partial = '' # The raw text of a word that may continue in the next chunk
+    for chunk in iter_raw_chunks(source, chunk_size):
+        if type(chunk) is not str and chunk.isascii() and not decoder.getstate()[0] and partial.isascii():
+            head, partial = split_last_word(partial.encode('ascii') + chunk)
+            partial = partial.decode('ascii')
+            yield from head.translate(ASCII_LOWER, ASCII_DELETE).decode('ascii').split()
+        else:
+            head, partial = split_last_word(partial + (chunk if type(chunk) is str else decoder.decode(chunk)))
+            yield from head.lower().translate(NORMALIZE_TABLE).split()
+    partial += decoder.decode(b'', final=True)
+    yield from partial.lower().translate(NORMALIZE_TABLE).split()
+
+# Demo:
+print("First five words:", list(islice(iter_normalized_words(latin_text.encode()), 5)))
+
+
+# In[ ]:
+
+
+# `iter_normalized_words_test`: Test cell
+import mmap
+from io import BytesIO, StringIO
+
+def check_normalized_words(text):
+    words_true = get_normalized_words(normalize_string(text))
+    data = text.encode('utf-8')
+    for chunk_size in [1, 2, 3, 7, 64, 1 << 20]:
+        assert list(iter_normalized_words(data, chunk_size)) == words_true
+        assert list(iter_normalized_words(BytesIO(data), chunk_size)) == words_true
+        assert list(iter_normalized_words(StringIO(text), chunk_size)) == words_true
+
+check_normalized_words(latin_text)
+check_normalized_words(english_text)
+check_normalized_words("Ça, c'est déjà l'été—naïve CAFÉ-crème,\tüber\x1c«straße»!")
+check_normalized_words("")
+check_normalized_words("  ...  ")
+check_normalized_words("ΟΔΟΣΑ ΟΔΟΣ ΟΔΟΣ1Α ΟΔΟΣ.Α Σ ΣΑ ΟΔΟΣA\x1cΑΣ")
+assert list(iter_normalized_words("ΟΔΟΣΑ ΟΔΟΣ".encode(), 4)) == ['οδοσα', 'οδος']
+
+with TemporaryDirectory() as tmp:
+    latin_path = os.path.join(tmp, 'latin_text.txt')
+    with open(latin_path, 'w', encoding='utf-8') as f:
+        f.write(latin_text * 3)
+    with open(latin_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        assert list(iter_normalized_words(buffer, 100)) == get_normalized_words(normalize_string(latin_text * 3))
+    assert list(iter_normalized_words(latin_path, 100)) == get_normalized_words(normalize_string(latin_text * 3))
+
+print("\n(Passed!)")
+
+
+# **Benchmark.** Here is roughly 20 MB of text, normalized the old way and the new way:
+
+# In[ ]:
+
+
+big_text = (latin_text + english_text) * 5000
+big_data = big_text.encode()
+print("{:.1f} MB".format(len(big_data) / 1e6))
+
+t_old = get_ipython().magic('timeit -q -o -n 1 -r 1 get_normalized_words(normalize_string(big_text))')
+t_new = get_ipython().magic('timeit -q -o -n 1 -r 3 for _ in iter_normalized_words(big_data): pass')
+print("normalize_string + split: {:.1f} MB/s".format(len(big_data) / t_old.best / 1e6))
+print("iter_normalized_words:    {:.1f} MB/s".format(len(big_data) / t_new.best / 1e6))
+
+
+# ## Bitmask itemsets for small alphabets
+# 
+# When the items are letters, as in the Latin and English examples, the whole alphabet fits in the bits of one 64-bit integer. So instead of a Python `set` per word, we can represent each itemset as a single _bitmask_, where bit $i$ is set if the word contains the $i$-th letter of the alphabet, and keep all of the bitmasks in one NumPy array.
+# 
+# Counting then becomes vectorized bit manipulation over all words at once:
+# 
+# - `make_bitmask_itemsets` finds the alphabet and computes every word's bitmask with a single `np.bitwise_or.reduceat` over the characters of the concatenated words.
+# - Many words share the same set of letters, so `count_bitmask_items_and_pairs` first collapses the bitmasks into distinct values with their multiplicities. It then unpacks each distinct bitmask into a 0/1 row of a (small) matrix $B$ and weights it by its multiplicity $w$, which gives the item counts as $w^T B$ and the full pair-count matrix (e.g., $26 \times 26$) as $B^T \mathrm{diag}(w) B$.
+# 
+# This path is available as `find_assoc_rules(..., backend='bitmask')`, for receipts whose items are single characters.
+
+# In[ ]:
+
+
+def make_bitmask_itemsets(words):
+    """
+    Given a list of strings, returns the sorted list of distinct
+    characters (the alphabet, of at most 64 characters) and a NumPy
+    array holding each string's set of characters as a bitmask.
+    """
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    codes = np.frombuffer(''.join(words).encode('utf-32-le'), dtype='<u4')
+    present = np.zeros(0x110000, dtype=bool)
+    present[codes] = True
+    alphabet_codes = np.flatnonzero(present)
+    if len(alphabet_codes) > 64:
+        raise ValueError("Alphabet too large for 64-bit masks: {} characters".format(len(alphabet_codes)))
+    bit = (np.cumsum(present, dtype=np.uint64) - np.uint64(1))[codes]
+    bits = np.left_shift(np.uint64(1), bit)
+    masks = np.zeros(len(words), dtype=np.uint64)
+    nonempty = lengths > 0
+    if nonempty.any():
+        starts = np.cumsum(lengths) - lengths
+        masks[nonempty] = np.bitwise_or.reduceat(bits, starts[nonempty])
+    return [chr(c) for c in alphabet_codes.tolist()], masks
+
+def count_bitmask_items_and_pairs(masks, num_items):
+    """
+    Returns the item counts and the (dense) pair-count matrix, with a
+    zero diagonal, of the bitmask itemsets `masks`.
+    """
+    distinct, multiplicity = np.unique(masks, return_counts=True)
+    B = np.unpackbits(distinct.astype('<u8').view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    B = B[:, :num_items].astype(np.int64)
+    item_counts = multiplicity @ B
+    pair_counts = (B * multiplicity[:, None]).T @ B
+    np.fill_diagonal(pair_counts, 0)
+    return item_counts, pair_counts
+
+def single_char_words(receipts):
+    """
+    Returns each receipt as a string of its items, which must all be
+    single characters.
+    """
+    words = []
+    for rep in receipts:
+        if type(rep) is not str:
+            if not all(type(item) is str and len(item) == 1 for item in rep):
+                raise ValueError("The bitmask backend needs single-character items, not {!r}".format(rep))
+            rep = ''.join(rep)
+        words.append(rep)
+    return words
+
+def find_assoc_rules_bitmask(receipts, threshold, count=None):
+    alphabet, masks = make_bitmask_itemsets(single_char_words(receipts))
+    item_counts, pair_counts = count_bitmask_items_and_pairs(masks, len(alphabet))
+    return filter_rules_by_conf_sparse(alphabet, item_counts, sparse.csr_matrix(pair_counts), threshold, count)
+
+ASSOC_RULE_BACKENDS['bitmask'] = find_assoc_rules_bitmask
+
+# Demo:
+alphabet, masks = make_bitmask_itemsets(['error', 'dolor', ''])
+print("Alphabet:", alphabet)
+for w, mask in zip(['error', 'dolor', ''], masks.tolist()):
+    print("{!r:>8} => {:0{}b}".format(w, mask, len(alphabet)))
+
+
+# In[ ]:
+
+
+# `find_assoc_rules_bitmask_test`: Test cell
+alphabet, masks = make_bitmask_itemsets(norm_latin_words)
+bitmask_item_counts, bitmask_pair_counts = count_bitmask_items_and_pairs(masks, len(alphabet))
+latin_item_counts, latin_pair_counts = count_receipts(norm_latin_itemsets)
+assert dict(zip(alphabet, bitmask_item_counts.tolist())) == latin_item_counts
+for (a, b), n_ab in latin_pair_counts.items():
+    assert bitmask_pair_counts[alphabet.index(a), alphabet.index(b)] == n_ab
+assert bitmask_pair_counts.sum() == sum(latin_pair_counts.values())
+
+check_same_rules(find_assoc_rules(norm_latin_itemsets, 0.75, backend='bitmask'), latin_rules)
+check_same_rules(find_assoc_rules(norm_english_words, 0.75, backend='bitmask'), english_rules)
+check_same_rules(find_assoc_rules(norm_english_itemsets, 0.3, 20, backend='bitmask'),
+                 find_assoc_rules(norm_english_itemsets, 0.3, 20))
+
+# Other items are rejected, rather than split into letters
+for receipts in [[['milk', 'bread'], ['milk']], [{'a', ''}], [{'', 'ab'}], [[1, 2]], [[chr(c) for c in range(100, 200)]]]:
+    try:
+        find_assoc_rules(receipts, 0.0, backend='bitmask', prune=False)
+        assert False, "Expected a ValueError"
+    except ValueError:
+        pass
+
+big_words = list(iter_normalized_words(big_data))[:500000]
+get_ipython().magic('timeit -n 1 -r 1 find_assoc_rules(make_itemsets(big_words), 0.75)')
+get_ipython().magic("timeit -n 1 -r 3 find_assoc_rules(big_words, 0.75, backend='bitmask')")
+
+print("\n(Passed!)")
+
+
+# ## Saving the count tables
+# 
+# Once we have the item and pair counts for a corpus, every rule, for _any_ confidence threshold and minimum count, can be derived from them. Yet until now we have thrown the tables away after each call, so every new question means recounting all of the receipts.
+# 
+# The functions below save the tables to a compact binary file and load them back. The file holds:
+# 
+# 1. an 8-byte "magic" tag and a header with the number of items, the size of the item dictionary, and the number and lengths of the arrays that follow;
+# 2. the item dictionary, in which each item name is stored once (interned) as UTF-8 bytes, located by an array of offsets;
+# 3. the item counts, as an array of 64-bit integers, indexed by item id; and
+# 4. the pair counts in the half-storage layout of `SymmetricPairCounts`: sorted packed keys $i \cdot m + j$, with $i < j$, and their counts.
+# 
+# All integers are little-endian and every array starts on an 8-byte boundary, so `load_count_tables` can memory-map the file and view the arrays in place with `np.frombuffer`, without reading or copying them. (The general layout, an item dictionary followed by arrays, is handled by `write_table_file` and `read_table_file`, which we will reuse later.)
+# 
+# Passing `save_counts=path` to `find_assoc_rules` saves the tables as a side effect. The rules are still mined as usual, with whichever backend and options were requested. (The saved tables are counted separately, with the sparse backend and without pruning, so that they can answer later queries with any minimum count.) Then, `find_assoc_rules_from_counts(path, threshold, count)` derives rules from the saved tables without looking at the receipts at all.
+
+# In[ ]:
+
+
+import mmap
+import os
+
+COUNT_FILE_MAGIC = b'ASSOCNT2' # version 2: the header also gives the number and lengths of the arrays
+
+def write_table_file(path, magic, items, arrays):
+    """
+    Writes an 8-byte `magic` tag, the interned item names, and a list of
+    one-dimensional arrays of 8-byte values (e.g., '<i8' or '<f8') to `path`.
+    """
+    assert all(type(item) is str for item in items), "Item names must be strings"
+    names = [item.encode('utf-8') for item in items]
+    offsets = np.zeros(len(names)+1, dtype='<i8')
+    offsets[1:] = np.cumsum([len(name) for name in names])
+    blob = b''.join(names)
+    blob += b'\0' * (-len(blob) % 8)
+    header = np.array([len(items), len(blob), len(arrays)] + [len(array) for array in arrays], dtype='<i8')
+    with open(path, 'wb') as f:
+        f.write(magic)
+        f.write(header.tobytes())
+        f.write(offsets.tobytes())
+        f.write(blob)
+        for array in arrays:
+            assert array.dtype.itemsize == 8
+            f.write(array.astype(array.dtype.newbyteorder('<')).tobytes())
+
+def read_table_file(path, magic, dtypes):
+    """
+    Memory-maps a file written by `write_table_file`. Returns the list of
+    items and a list of read-only arrays, with the given `dtypes`, that
+    view the file in place.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:8] != magic:
+        raise ValueError("Not a {} file: {}".format(magic.decode(), path))
+    num_items, blob_size, num_arrays = np.frombuffer(buffer, '<i8', 3, offset=8).tolist()
+    if num_arrays != len(dtypes):
+        raise ValueError("Expected {} arrays but found {}: {}".format(len(dtypes), num_arrays, path))
+    lengths = np.frombuffer(buffer, '<i8', num_arrays, offset=32).tolist()
+    pos = 32 + 8*num_arrays
+    offsets = np.frombuffer(buffer, '<i8', num_items+1, offset=pos).tolist()
+    pos += 8*(num_items+1)
+    blob = buffer[pos:pos+blob_size]
+    items = [blob[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+    pos += blob_size
+    arrays = []
+    for dtype, length in zip(dtypes, lengths):
+        arrays.append(np.frombuffer(buffer, dtype, length, offset=pos))
+        pos += 8*length
+    return items, arrays
+
+def save_count_tables(path, items, item_counts, pair_counts):
+    """
+    Saves item counts, indexed by item id, and pair counts, either a
+    sparse matrix or a `SymmetricPairCounts`, to the file `path`.
+    """
+    if not isinstance(pair_counts, SymmetricPairCounts):
+        pair_counts = SymmetricPairCounts.from_matrix(items, pair_counts)
+    arrays = [item_counts, pair_counts.keys_packed, pair_counts.counts]
+    write_table_file(path, COUNT_FILE_MAGIC, items, [np.asarray(array, dtype='<i8') for array in arrays])
+
+def load_count_tables(path):
+    """
+    Memory-maps a file written by `save_count_tables`. Returns the list
+    of items, the item counts and a `SymmetricPairCounts`.
+    """
+    items, (item_counts, keys, counts) = read_table_file(path, COUNT_FILE_MAGIC, ['<i8'] * 3)
+    return items, item_counts, SymmetricPairCounts(items, keys, counts)
+
+def filter_rules_by_conf_half(items, item_counts, half_counts, threshold, count=None):
+    """
+    Same as `filter_rules_by_conf`, for pair counts in a `SymmetricPairCounts`.
+    """
+    assert list(items) == half_counts.vocab
+    return half_counts.filter_rules(item_counts, threshold, count)
+
+def find_assoc_rules_from_counts(path, threshold, count=None):
+    return filter_rules_by_conf_half(*load_count_tables(path), threshold, count)
+
+# Demo:
+groceries_counts_path = scratch_path('groceries.counts')
+rules = find_assoc_rules(l, THRESHOLD, MIN_COUNT, save_counts=groceries_counts_path)
+saved_items, saved_item_counts, saved_pair_counts = load_count_tables(groceries_counts_path)
+print("Saved {} items and {} distinct pairs in {:,} bytes".format(
+      len(saved_items), len(saved_pair_counts.keys_packed), os.path.getsize(groceries_counts_path)))
+
+
+# In[ ]:
+
+
+# `count_tables_file_test`: Test cell
+check_same_rules(rules, basket_rules)
+assert dict(zip(saved_items, saved_item_counts.tolist())) == item_counts
+assert dict(saved_pair_counts) == dict(pair_counts)
+assert not saved_item_counts.flags.owndata and not saved_item_counts.flags.writeable # a view into the file
+
+for threshold, count in [(THRESHOLD, MIN_COUNT), (0.2, None), (0.3, 100), (0.0, 1)]:
+    check_same_rules(find_assoc_rules_from_counts(groceries_counts_path, threshold, count),
+                     filter_rules_by_conf(pair_counts, item_counts, threshold, count))
+
+with TemporaryDirectory() as tmp:
+    weird_receipts = [{'', 'crème brûlée', 'a,b'}, {'crème brûlée', '日本茶'}, {''}]
+    find_assoc_rules(weird_receipts, 0.0, save_counts=os.path.join(tmp, 'weird.counts'))
+    check_same_rules(find_assoc_rules_from_counts(os.path.join(tmp, 'weird.counts'), 0.0),
+                     find_assoc_rules(weird_receipts, 0.0))
+    find_assoc_rules([], 0.0, save_counts=os.path.join(tmp, 'empty.counts'))
+
+    # Saving the tables does not change the result of any backend
+    apriori_rules = find_assoc_rules(norm_latin_itemsets, 0.75, backend='apriori', max_size=3)
+    check_same_rules(find_assoc_rules(norm_latin_itemsets, 0.75, backend='apriori', max_size=3,
+                                      save_counts=os.path.join(tmp, 'latin.counts')), apriori_rules)
+    assert len(apriori_rules) > len(latin_rules)
+    check_same_rules(find_assoc_rules_from_counts(os.path.join(tmp, 'latin.counts'), 0.75), latin_rules)
+    check_same_rules(find_assoc_rules(iter(l), THRESHOLD, MIN_COUNT, backend='dict',
+                                      save_counts=os.path.join(tmp, 'groceries.counts')), basket_rules)
+    assert find_assoc_rules_from_counts(os.path.join(tmp, 'empty.counts'), 0.0) == {}
+
+    # Files in the older layout, or of another kind, are rejected
+    with open(os.path.join(tmp, 'old.counts'), 'wb') as f:
+        f.write(b'ASSOCNT1' + np.array([2, 1, 8], dtype='<i8').tobytes())
+    write_table_file(os.path.join(tmp, 'other.table'), b'OTHERTBL', ['a'], [np.zeros(2, dtype='<i8')] * 3)
+    for name in ['old.counts', 'other.table']:
+        try:
+            load_count_tables(os.path.join(tmp, name))
+            assert False, "Expected a ValueError"
+        except ValueError:
+            pass
+
+print("\n(Passed!)")
+
+
+# ## Just the top rules
+# 
+# `print_rules` sorts _every_ rule by confidence and formats every one of them with `gen_rule_str`, even when we only want to look at the best 20. With millions of candidate rules, that is a lot of wasted sorting and string building.
+# 
+# To get the $k$ best of $n$ rules, it is enough to keep a _bounded heap_ of the best $k$ seen so far, which costs $O(n \log k)$ instead of $O(n \log n)$. Python's `heapq.nlargest` does exactly this. The function `top_rules`, below, uses it to return the $k$ highest-confidence rules, or, with `per_antecedent=True`, the $k$ best rules for each antecedent, using one small heap per antecedent. Among rules with equal confidence, those that come first in `rules` are preferred.
+# 
+# If the rules are already in a `RuleIndex`, they are sorted, so the top $k$ are simply the last $k$ entries that pass the count filter; that is what the method `RuleIndex.top`, defined earlier, returns.
+# 
+# Lastly, `print_rules` takes an optional `k`, in which case only the returned rules are ever formatted.
+
+# In[ ]:
+
+
+from heapq import nlargest, heappush, heapreplace
+from operator import itemgetter
+
+def top_rules(rules, k, per_antecedent=False):
+    """
+    Returns the `k` highest-confidence rules as a list of `((a, b), conf)`
+    pairs, in decreasing order of confidence. If `per_antecedent` is set,
+    instead returns a dictionary that maps each antecedent `a` to such a
+    list of its (at most) `k` best rules.
+    """
+    if not per_antecedent:
+        return nlargest(k, rules.items(), key=itemgetter(1))
+    if k <= 0:
+        return {}
+    heaps = defaultdict(list)
+    for seq, ((a, b), conf) in enumerate(rules.items()):
+        heap = heaps[a]
+        if len(heap) < k:
+            heappush(heap, (conf, -seq, b))
+        elif conf > heap[0][0]:
+            heapreplace(heap, (conf, -seq, b))
+    return {a: [((a, b), conf) for conf, _, b in sorted(heap, reverse=True)] for a, heap in heaps.items()}
+
+def print_rules(rules, k=None, per_antecedent=False):
+    if k is not None:
+        if per_antecedent:
+            ordered_rules = [rule for group in top_rules(rules, k, True).values() for rule in group]
+        else:
+            ordered_rules = top_rules(rules, k)
+    elif type(rules) is dict or type(rules) is defaultdict:
+        ordered_rules = sorted(rules.items(), key=itemgetter(1), reverse=True)
+    else: # Assume rules is iterable
+        ordered_rules = [((a, b), None) for a, b in rules]
+    for (a, b), conf_ab in ordered_rules:
+        print(gen_rule_str(a, b, conf_ab))
+
+# Demo:
+print("Top 5 rules among {:,} candidates:".format(len(pair_counts)))
+print_rules(filter_rules_by_conf(pair_counts, item_counts, 0.0), k=5)
+
+
+# In[ ]:
+
+
+# `top_rules_test`: Test cell
+all_rules = filter_rules_by_conf(pair_counts, item_counts, 0.0)
+ordered = sorted(all_rules.items(), key=itemgetter(1), reverse=True)
+for k in [0, 1, 20, len(all_rules), len(all_rules) + 5]:
+    assert top_rules(all_rules, k) == ordered[:k]
+
+grouped = top_rules(all_rules, 3, per_antecedent=True)
+assert grouped.keys() == {a for a, _ in all_rules}
+for a, group in grouped.items():
+    assert group == [rule for rule in ordered if rule[0][0] == a][:3]
+assert top_rules(all_rules, 0, per_antecedent=True) == {}
+
+top_index = basket_index.top(20, MIN_COUNT)
+assert [conf for _, conf in top_index] == [conf for _, conf in top_rules(basket_index.query(0, MIN_COUNT), 20)]
+assert {key for key, _ in basket_index.top(len(basket_rules), MIN_COUNT)} == set(basket_rules)
+
+get_ipython().magic('timeit print_rules(all_rules, k=20)')
+print("\n(Passed!)")
+
+
+# ## Approximate pair counts in bounded memory
+# 
+# The number of distinct co-occurring pairs can grow roughly with the square of the vocabulary, so for a large enough vocabulary the `pair_counts` table eventually exhausts memory, no matter how compactly each entry is stored.
+# 
+# A _Count-Min sketch_ trades exactness for a fixed memory budget. It is a $d \times w$ table of counters with one hash function per row. To count a key, we hash it once per row and increment the corresponding counter; to estimate its count $n$, we take the _minimum_ of its $d$ counters, $\hat{n}$. Collisions can only inflate counters, so $\hat{n} \geq n$ always. Moreover, if $N$ is the total of all counts added, then with probability at least $1 - e^{-d}$,
+# 
+# $$\hat{n} \leq n + \frac{e}{w} N.$$
+# 
+# The class `PairCountSketch` is such a sketch for item-pairs, with a few twists:
+# 
+# - It uses _conservative updates_: an increment only raises the counters that are below the new estimate, which never hurts and often helps accuracy. Conveniently, this is exactly what `pair_counts[(a, b)] += 1` means, so a sketch supports that syntax, too.
+# - Every item gets $d$ pseudo-random offsets $x_r(a)$ and $y_r(a)$, computed by hashing its id (so that no table of offsets is stored), and the pair $(a, b)$ hashes to $(x_r(a) + y_r(b)) \bmod w$ in row $r$. Distinct pairs collide with probability $1/w$, which is what the bound needs. Since pair hashes are sums of item offsets, all pairs of a receipt can be hashed and counted in one vectorized step (`add_itemset`).
+# - It also keeps, exactly, the _pair total_ $S_a = \sum_b n_{ab}$ of every item: the number of pairs counted with $a$ as the antecedent.
+# 
+# The item counts stay exact in an ordinary dictionary: the vocabulary is small compared with the pair table. So do the pair totals and the item ids; these $O(m)$ per-item tables are the only ones outside the memory budget.
+# 
+# A rule $a \Rightarrow b$ is a _candidate_ if its upper bound, $\hat{n}_{ab} / n_a$, meets the threshold. Since $\hat{n}_{ab} \geq n_{ab}$, no true rule is ever missed. But we must not test every one of the $m^2$ pairs of items: once the sketch saturates, nearly all of them would pass. Instead, `approx_rule_bounds` makes a pass over the receipts, so that only pairs that actually occur together are considered, and it feeds each one that passes the test into a _Misra-Gries_ summary for its antecedent. A Misra-Gries summary with $k$ counters keeps every element that occurs more than $1/(k+1)$ of the time, in memory proportional to $k$. Since a true rule has $n_{ab} \geq \theta n_a$ out of at most $S_a$ pairs with antecedent $a$, a summary with
+# 
+# $$k_a = \left\lfloor \frac{S_a}{\theta n_a} \right\rfloor + 1$$
+# 
+# counters (or just $S_a$ when $\theta = 0$) keeps all of them. So the candidates number at most $\sum_a k_a \leq \sum_a (L_a / \theta + 1)$, where $L_a = S_a / n_a$ is the average number of other items in a receipt containing $a$. That is linear in the vocabulary, not quadratic; `candidate_capacities` computes the $k_a$ (also capped by $S_a$ and by $m - 1$), so that the budget can be checked before the pass. Each candidate costs roughly `CANDIDATE_BYTES` bytes, for its counter, its bounds and, later, its exact count.
+# 
+# `approx_rule_bounds` returns each candidate's confidence interval, whose lower end uses $\max(0, \hat{n}_{ab} - eN/w) / n_a$. Finally, `find_assoc_rules_approx` can (with `verify=True`, the default) make one more pass over the receipts that counts _only_ the candidate pairs exactly. That pass drops the false positives and returns exactly the rules of `find_assoc_rules`. It is available as `find_assoc_rules(..., backend='approx', memory_bytes=...)`. Half of `memory_bytes` goes to the sketch and half to the candidates; if the candidates might not fit, it raises a `ValueError` before the pass, and the caller should raise the threshold (or the budget).
+
+# In[ ]:
+
+
+from math import e as E
+
+class PairCountSketch:
+    """
+    Count-Min sketch, with conservative updates, of item-pair counts,
+    using about `memory_bytes` bytes of counters.
+    """
+    def __init__(self, memory_bytes=1 << 20, depth=4, seed=6040):
+        self.depth = depth
+        self.width = max(1, memory_bytes // (8 * depth))
+        self.table = np.zeros((depth, self.width), dtype=np.int64)
+        self.rows = np.arange(depth)
+        self.total = 0
+        self.item_ids = {}
+        self.pair_totals = np.zeros(0, dtype=np.int64) # by item id, exact
+        self.seed = np.uint64(seed)
+
+    def _ids(self, items):
+        for item in items:
+            if item not in self.item_ids:
+                self.item_ids[item] = len(self.item_ids)
+        if len(self.item_ids) > len(self.pair_totals):
+            self.pair_totals = np.pad(self.pair_totals, (0, max(len(self.item_ids), 2*len(self.pair_totals)) - len(self.pair_totals)))
+        return np.array([self.item_ids[item] for item in items], dtype=np.int64)
+
+    def _known_ids(self, items):
+        """Same as `_ids`, but skips items that were never counted instead of adding them."""
+        return np.array([self.item_ids[item] for item in items if item in self.item_ids], dtype=np.int64)
+
+    def _offsets(self, ids, side):
+        """
+        Returns the offsets x_r(a) (side 0) or y_r(a) (side 1) of the
+        items with `ids` in every row, as a (k x depth) array. They are
+        pseudo-random but computed from the ids (with SplitMix64), so no
+        per-item table is stored.
+        """
+        z = (np.asarray(ids, dtype=np.uint64)[..., np.newaxis] * np.uint64(2*self.depth)
+             + np.uint64(side*self.depth) + self.rows.astype(np.uint64))
+        z = z * np.uint64(0x9E3779B97F4A7C15) + self.seed
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z ^= z >> np.uint64(31)
+        return (z % np.uint64(self.width)).astype(np.int64)
+
+    def _cells(self, a_ids, b_ids):
+        """Returns the column of each pair (a_ids[k], b_ids[k]) in every row, as a (k x depth) array."""
+        return (self._offsets(a_ids, 0) + self._offsets(b_ids, 1)) % self.width
+
+    def _estimate(self, cells):
+        return self.table[self.rows, cells].min(axis=-1)
+
+    def __getitem__(self, key):
+        if not all(item in self.item_ids for item in key):
+            return 0 # Never counted (and a lookup does not add items)
+        a_id, b_id = self._known_ids(key)
+        return int(self._estimate(self._cells(a_id, b_id)))
+
+    def __setitem__(self, key, value):
+        increment = value - self[key]
+        assert increment >= 0, "Count-Min sketches only support increments"
+        a_id, b_id = self._ids(key)
+        cells = self._cells(a_id, b_id)
+        self.total += int(increment)
+        self.pair_totals[a_id] += increment
+        np.maximum.at(self.table, (self.rows, cells), self._estimate(cells) + increment)
+
+    def add_itemset(self, itemset):
+        """Counts all ordered pairs of distinct items in `itemset` at once."""
+        ids = self._ids(list(set(itemset)))
+        a_ids, b_ids = np.meshgrid(ids, ids, indexing='ij')
+        distinct = a_ids != b_ids
+        cells = self._cells(a_ids[distinct], b_ids[distinct])
+        if len(cells):
+            new_counts = self._estimate(cells) + 1
+            for r in self.rows:
+                np.maximum.at(self.table[r], cells[:, r], new_counts)
+            self.total += len(cells)
+            self.pair_totals[ids] += len(ids) - 1
+
+    def error_bound(self):
+        """
+        Returns the additive error bound, e*N/w, which holds for any one
+        estimate with probability at least 1 - e^(-depth).
+        """
+        return E * self.total / self.width
+
+# Rough memory per candidate rule, in bytes: its Misra-Gries counter, its
+# entry in the dictionary of bounds, and its exact count in the verifying pass
+CANDIDATE_BYTES = 400
+
+def candidate_capacities(item_counts, sketch, threshold, count=None):
+    """
+    Returns an array, by sketch item id, of the number of candidate
+    consequents to keep for each antecedent (0 if it cannot have rules).
+    """
+    n = np.zeros(len(sketch.pair_totals), dtype=np.int64)
+    for item, n_a in item_counts.items():
+        n[sketch.item_ids[item]] = n_a
+    totals = sketch.pair_totals
+    capacities = np.minimum(totals, len(sketch.item_ids) - 1) # No more than the distinct consequents
+    if threshold > 0:
+        capacities = np.minimum(capacities, totals // np.maximum(np.ceil(threshold * n), 1).astype(np.int64) + 1)
+    if count is not None:
+        capacities[n < count] = 0
+    capacities[n == 0] = 0
+    return capacities
+
+def approx_rule_bounds(receipts, item_counts, sketch, threshold, count=None, memory_bytes=None):
+    """
+    Returns a dictionary mapping every candidate rule (a, b), i.e., one
+    that occurs in `receipts` and whose upper confidence bound meets
+    `threshold`, to the pair (conf_lo, conf_hi) of lower and upper bounds
+    on its confidence. It holds at most
+    `candidate_capacities(item_counts, sketch, threshold, count).sum()`
+    rules, yet includes every true rule.
+
+    If `memory_bytes` is given, raises a `ValueError`, before the pass,
+    unless that many candidates fit in it (see `CANDIDATE_BYTES`).
+    """
+    capacities = candidate_capacities(item_counts, sketch, threshold, count)
+    if memory_bytes is not None and capacities.sum() * CANDIDATE_BYTES > memory_bytes:
+        raise ValueError("Up to {:,} candidate rules need {:,} bytes, but only {:,} are left; "
+                         "raise the threshold, count or memory_bytes".format(
+                         capacities.sum(), capacities.sum() * CANDIDATE_BYTES, memory_bytes))
+    n = np.zeros(len(capacities), dtype=np.int64)
+    for item, n_a in item_counts.items():
+        n[sketch.item_ids[item]] = n_a
+    summaries = defaultdict(dict) # antecedent id -> {consequent id: Misra-Gries counter}
+    for rep in receipts:
+        ids = sketch._known_ids(set(rep))
+        a_ids, b_ids = np.meshgrid(ids, ids, indexing='ij')
+        distinct = a_ids != b_ids
+        a_ids, b_ids = a_ids[distinct], b_ids[distinct]
+        n_a = n[a_ids]
+        keep = (capacities[a_ids] > 0) & (n[b_ids] >= threshold * n_a)
+        keep[keep] = sketch._estimate(sketch._cells(a_ids[keep], b_ids[keep])) >= threshold * n_a[keep]
+        for a, b in zip(a_ids[keep].tolist(), b_ids[keep].tolist()):
+            summary = summaries[a]
+            if b in summary:
+                summary[b] += 1
+            elif len(summary) < capacities[a]:
+                summary[b] = 1
+            else: # Full: decrement every counter, and drop the ones that reach zero
+                for c in list(summary):
+                    summary[c] -= 1
+                    if summary[c] == 0:
+                        del summary[c]
+    items = list(sketch.item_ids)
+    slack = sketch.error_bound()
+    bounds = {}
+    for a, summary in summaries.items():
+        b_ids = np.fromiter(summary, dtype=np.int64, count=len(summary))
+        n_ab = sketch._estimate(sketch._cells(a, b_ids))
+        for b, n_ab_hi in zip(b_ids.tolist(), n_ab.tolist()):
+            bounds[(items[a], items[b])] = (max(0, n_ab_hi - slack) / n[a], n_ab_hi / n[a])
+    return bounds
+
+def find_assoc_rules_approx(receipts, threshold, count=None, memory_bytes=1 << 22, depth=4, verify=True):
+    """
+    Mines pairwise rules with a `PairCountSketch`. The pair-level tables
+    fit in `memory_bytes`: half goes to the sketch's counters and half to
+    the candidate rules, or else a `ValueError` is raised. (The exact item
+    counts and pair totals take O(m) memory on top of that.)
+    """
+    receipts = list(receipts)
+    item_counts = defaultdict(int)
+    sketch = PairCountSketch(memory_bytes // 2, depth)
+    for rep in receipts:
+        update_item_counts(item_counts, rep)
+        sketch.add_itemset(rep)
+    bounds = approx_rule_bounds(receipts, item_counts, sketch, threshold, count,
+                                memory_bytes=memory_bytes - sketch.table.nbytes)
+    if not verify:
+        return {key: conf_hi for key, (_, conf_hi) in bounds.items()}
+    pair_counts = defaultdict(int) # Only candidates, so no larger than `bounds`
+    for rep in receipts:
+        for a, b in combinations(rep, 2):
+            if (a, b) in bounds:
+                pair_counts[(a, b)] += 1
+            if (b, a) in bounds:
+                pair_counts[(b, a)] += 1
+    return filter_rules_by_conf(pair_counts, item_counts, threshold, count)
+
+ASSOC_RULE_BACKENDS['approx'] = find_assoc_rules_approx
+
+# Demo:
+sketch = PairCountSketch(memory_bytes=4096)
+for rep in [set('abbc'), set('ac'), set('a')]:
+    sketch.add_itemset(rep)
+print("{} x {} sketch: count(a, c) ~ {}, error bound {:.3f}".format(
+      sketch.depth, sketch.width, sketch[('a', 'c')], sketch.error_bound()))
+
+
+# In[ ]:
+
+
+# `pair_count_sketch_test`: Test cell
+for memory_bytes in [1 << 12, 1 << 16]:
+    sketch = PairCountSketch(memory_bytes)
+    for rep in l[:len(l)//2]:
+        for a, b in combinations(set(rep), 2):
+            sketch[(a, b)] += 1
+            sketch[(b, a)] += 1
+    for rep in l[len(l)//2:]:
+        sketch.add_itemset(rep)
+    assert sketch.total == sum(pair_counts.values())
+    pair_totals = defaultdict(int)
+    for (a, b), n in pair_counts.items():
+        pair_totals[a] += n
+    assert all(sketch.pair_totals[sketch.item_ids[a]] == n for a, n in pair_totals.items())
+    misses = sum(not (n <= sketch[key] <= n + sketch.error_bound()) for key, n in pair_counts.items())
+    print("{:,} bytes: bound {:.1f}, {} of {} pairs outside it".format(
+          memory_bytes, sketch.error_bound(), misses, len(pair_counts)))
+    assert all(sketch[key] >= n for key, n in pair_counts.items())
+    assert misses <= len(pair_counts) * E**-sketch.depth
+    num_items = len(sketch.item_ids)
+    assert sketch[('no such item', 'whole milk')] == 0 and len(sketch.item_ids) == num_items # Lookups do not add items
+
+    bounds = approx_rule_bounds(l, item_counts, sketch, THRESHOLD, MIN_COUNT)
+    assert set(basket_rules) <= set(bounds) <= set(pair_counts)
+    assert len(bounds) <= candidate_capacities(item_counts, sketch, THRESHOLD, MIN_COUNT).sum()
+    assert all(lo <= hi for lo, hi in bounds.values())
+
+# A large vocabulary and a saturated sketch: the candidates stay within the capacity
+# (linear in the vocabulary) and are all pairs that actually occur
+zipf_baskets = gen_synthetic_baskets(5000, num_items=3000)
+zipf_item_counts, zipf_pair_counts = count_receipts(zipf_baskets)
+for threshold, count in [(0.5, None), (0.1, 5), (0.0, None)]:
+    sketch = PairCountSketch(memory_bytes=1 << 12)
+    for rep in zipf_baskets:
+        sketch.add_itemset(rep)
+    bounds = approx_rule_bounds(zipf_baskets, zipf_item_counts, sketch, threshold, count)
+    capacity = candidate_capacities(zipf_item_counts, sketch, threshold, count).sum()
+    print("threshold={}: {:,} candidates, capacity {:,}, {:,} distinct pairs".format(
+          threshold, len(bounds), capacity, len(zipf_pair_counts)))
+    assert set(filter_rules_by_conf(zipf_pair_counts, zipf_item_counts, threshold, count)) <= set(bounds)
+    assert set(bounds) <= set(zipf_pair_counts) and len(bounds) <= capacity
+get_ipython().magic('timeit -n 1 -r 1 approx_rule_bounds(zipf_baskets, zipf_item_counts, sketch, 0.5)')
+
+# Candidates that cannot fit in the budget are refused before the pass
+wide_baskets = gen_synthetic_baskets(2000, num_items=20000)
+for threshold in [0.0, 0.5]:
+    try:
+        find_assoc_rules_approx(wide_baskets, threshold, memory_bytes=1 << 12)
+        assert False, "Expected a ValueError"
+    except ValueError as err:
+        print("Refused:", err)
+wide_rules = find_assoc_rules(wide_baskets, 0.5)
+check_same_rules(find_assoc_rules_approx(wide_baskets, 0.5, memory_bytes=1 << 26), wide_rules)
+
+for memory_bytes in [1 << 10, 1 << 12]:
+    try:
+        find_assoc_rules(l, THRESHOLD, MIN_COUNT, backend='approx', memory_bytes=memory_bytes)
+        assert False, "Expected a ValueError"
+    except ValueError:
+        pass
+for memory_bytes in [1 << 22, 1 << 24]:
+    check_same_rules(find_assoc_rules(l, THRESHOLD, MIN_COUNT, backend='approx', memory_bytes=memory_bytes), basket_rules)
+check_same_rules(find_assoc_rules(norm_latin_itemsets, 0.75, backend='approx'), latin_rules)
+unverified = find_assoc_rules(l, THRESHOLD, MIN_COUNT, backend='approx', verify=False)
+assert set(basket_rules) <= set(unverified)
+
+print("\n(Passed!)")
+
+
+# ## A scaling benchmark
+# 
+# How does the miner behave as the number of baskets, the basket length, or the vocabulary grows? The only real inputs we have are the two _lorem ipsum_ texts and the groceries file, which are too small and too fixed to say much. So let's measure on synthetic baskets from `gen_synthetic_baskets` (defined earlier), whose items follow a Zipf distribution, like real product popularity, and whose lengths vary from basket to basket.
+# 
+# The function `run_benchmark` sweeps a grid of sizes. For every point of the grid and every counting backend, it records:
+# 
+# - the counting time, as both baskets per second and item-pairs per second;
+# - the peak memory allocated while counting, measured by `tracemalloc` in a separate, untimed run (tracing slows allocation down); and
+# - the time to filter the tables into rules.
+# 
+# `write_benchmark_results` saves the results, together with the Python and NumPy versions, as JSON, so that runs can be compared over time to catch regressions. They go to `BENCHMARK_RESULTS_PATH`, which, unlike the scratch files of this notebook, outlives it; change it to keep the results elsewhere.
+
+# In[ ]:
+
+
+import json
+import platform
+import tracemalloc
+from itertools import product
+from time import perf_counter
+
+def count_receipts_sparse(receipts):
+    items, X = encode_receipts(receipts)
+    return (items,) + count_items_and_pairs(X)
+
+def filter_counts_dict(tables, threshold, count):
+    item_counts, pair_counts = tables
+    return filter_rules_by_conf(pair_counts, item_counts, threshold, count)
+
+def filter_counts_sparse(tables, threshold, count):
+    return filter_rules_by_conf_sparse(*tables, threshold, count)
+
+# Where the notebook keeps its benchmark results, across runs
+BENCHMARK_RESULTS_PATH = os.path.join(os.path.expanduser('~'), 'assoc_benchmark.json')
+
+# name -> (count the receipts, filter the counts into rules)
+BENCHMARK_BACKENDS = {'dict': (count_receipts, filter_counts_dict),
+                      'sparse': (count_receipts_sparse, filter_counts_sparse)}
+
+def measure_peak_memory(f, *args):
+    """Returns the peak memory, in bytes, allocated while evaluating `f(*args)`."""
+    tracemalloc.start()
+    try:
+        f(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_benchmark(num_baskets=(5000, 20000), mean_len=(5, 15), num_items=(1000, 10000),
+                  backends=('dict', 'sparse'), threshold=0.5, count=10, seed=6040):
+    """
+    Benchmarks each backend over the grid of sizes. Returns a list of
+    dictionaries, one per (grid point, backend).
+    """
+    results = []
+    for n, k, m in product(num_baskets, mean_len, num_items):
+        baskets = gen_synthetic_baskets(n, m, k, seed=seed)
+        num_pairs = sum(len(b)*(len(b)-1) for b in baskets)
+        for backend in backends:
+            count_tables, filter_tables = BENCHMARK_BACKENDS[backend]
+            t0 = perf_counter()
+            tables = count_tables(baskets)
+            t1 = perf_counter()
+            rules = filter_tables(tables, threshold, count)
+            t2 = perf_counter()
+            results.append({'backend': backend, 'num_baskets': n, 'mean_len': k, 'num_items': m,
+                            'num_pairs': num_pairs, 'num_rules': len(rules),
+                            'count_seconds': t1 - t0, 'filter_seconds': t2 - t1,
+                            'baskets_per_second': n / (t1 - t0), 'pairs_per_second': num_pairs / (t1 - t0),
+                            'peak_count_bytes': measure_peak_memory(count_tables, baskets)})
+    return results
+
+def write_benchmark_results(path, results):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                   'results': results}, f, indent=1)
+
+def print_benchmark_results(results):
+    print("{:>7} {:>7} {:>4} {:>6} | {:>12} {:>10} {:>9}".format(
+          'backend', 'baskets', 'len', 'items', 'pairs/s', 'peak MB', 'filter s'))
+    for r in results:
+        print("{backend:>7} {num_baskets:>7} {mean_len:>4} {num_items:>6} | {pairs_per_second:>12,.0f} "
+              "{peak_mb:>10.1f} {filter_seconds:>9.4f}".format(peak_mb=r['peak_count_bytes'] / 2**20, **r))
+
+benchmark_results = run_benchmark()
+print_benchmark_results(benchmark_results)
+write_benchmark_results(BENCHMARK_RESULTS_PATH, benchmark_results)
+print("Results written to", BENCHMARK_RESULTS_PATH)
+
+
+# In[ ]:
+
+
+# `run_benchmark_test`: Test cell
+assert gen_synthetic_baskets(100, seed=1) == gen_synthetic_baskets(100, seed=1)
+assert gen_synthetic_baskets(100, seed=1) != gen_synthetic_baskets(100, seed=2)
+baskets = gen_synthetic_baskets(20000, num_items=100, mean_len=4, zipf_s=1.5)
+assert 2 < sum(map(len, baskets)) / len(baskets) <= 4
+popularity = count_receipts(baskets)[0]
+assert popularity['item0'] > popularity['item1'] > popularity['item9'] > popularity['item99']
+
+results = run_benchmark(num_baskets=[500], mean_len=[3, 6], num_items=[50])
+assert len(results) == 2 * len(BENCHMARK_BACKENDS)
+for r_dict, r_sparse in zip(results[0::2], results[1::2]):
+    assert r_dict['num_rules'] == r_sparse['num_rules']
+with TemporaryDirectory() as tmp:
+    write_benchmark_results(os.path.join(tmp, 'assoc_benchmark_test.json'), results)
+    with open(os.path.join(tmp, 'assoc_benchmark_test.json')) as f:
+        assert json.load(f)['results'] == results
+
+print("\n(Passed!)")
+
+
+# ## Comparing rules across many corpora
+# 
+# `intersect_keys` compares two rule dictionaries by building two key sets and intersecting them. To find the rules common to some subset of dozens of corpora (stores, languages, ...), repeating that means copying key sets over and over.
+# 
+# The class `MultiCorpusRules` instead interns every distinct rule key once, assigning it a row, and records, for each row:
+# 
+# - a 64-bit _bitmask_ whose bit $c$ is set if corpus $c$ contains the rule; and
+# - the rule's confidence in every corpus (or `nan` where it is absent).
+# 
+# Then "the rules common to this subset of corpora" becomes one vectorized test over all rows at once: `(masks & subset) == subset`, where `subset` has a bit set for each corpus in the subset. Similarly, "the rules in _any_ of these corpora" is `(masks & subset) != 0`.
+
+# In[ ]:
+
+
+from math import isnan
+
+class MultiCorpusRules:
+    """
+    Index of the rules of up to 64 corpora, given as a dictionary that
+    maps each corpus name to its rules (as returned by `find_assoc_rules`).
+    """
+    def __init__(self, corpus_rules):
+        assert len(corpus_rules) <= 64, "At most 64 corpora"
+        self.corpora = list(corpus_rules)
+        key_ids = {}
+        rows, cols, confs = [], [], []
+        for c, rules in enumerate(corpus_rules.values()):
+            for key, conf in rules.items():
+                rows.append(key_ids.setdefault(key, len(key_ids)))
+                cols.append(c)
+                confs.append(conf)
+        self.keys = list(key_ids)
+        self.key_ids = key_ids
+        rows = np.array(rows, dtype=np.int64)
+        cols = np.array(cols, dtype=np.uint64)
+        self.masks = np.zeros(len(self.keys), dtype=np.uint64)
+        np.bitwise_or.at(self.masks, rows, np.left_shift(np.uint64(1), cols))
+        self.conf = np.full((len(self.keys), len(self.corpora)), np.nan)
+        self.conf[rows, cols.astype(np.int64)] = confs
+
+    def subset_mask(self, corpora):
+        mask = 0
+        for name in corpora:
+            mask |= 1 << self.corpora.index(name)
+        return np.uint64(mask)
+
+    def _keys_where(self, selected):
+        return {self.keys[k] for k in np.flatnonzero(selected).tolist()}
+
+    def common(self, corpora):
+        """Returns the set of rules found in every one of `corpora`."""
+        mask = self.subset_mask(corpora)
+        return self._keys_where((self.masks & mask) == mask)
+
+    def in_any(self, corpora):
+        """Returns the set of rules found in at least one of `corpora`."""
+        return self._keys_where((self.masks & self.subset_mask(corpora)) != 0)
+
+    def confidences(self, key):
+        """Returns a dictionary mapping each corpus that has the rule `key` to its confidence."""
+        row = self.conf[self.key_ids[key]]
+        return {name: conf for name, conf in zip(self.corpora, row.tolist()) if not isnan(conf)}
+
+# Demo:
+corpus_index = MultiCorpusRules({'latin': latin_rules, 'english': english_rules})
+print("Rules common to Latin and English:")
+for key in corpus_index.common(['latin', 'english']):
+    print(gen_rule_str(*key), corpus_index.confidences(key))
+
+
+# In[ ]:
+
+
+# `multi_corpus_rules_test`: Test cell
+from random import Random
+
+assert corpus_index.common(['latin', 'english']) == intersect_keys(latin_rules, english_rules)
+assert corpus_index.in_any(['latin', 'english']) == set(latin_rules) | set(english_rules)
+assert corpus_index.common(['latin']) == set(latin_rules)
+
+stores = {'store{}'.format(s): find_assoc_rules(gen_synthetic_baskets(2000, 200, 6, seed=s), 0.3, 20)
+          for s in range(40)}
+stores['latin'] = latin_rules
+store_index = MultiCorpusRules(stores)
+rng = Random(0)
+for _ in range(20):
+    subset = rng.sample(list(stores), rng.randint(1, 6))
+    assert store_index.common(subset) == set.intersection(*[set(stores[name]) for name in subset])
+    assert store_index.in_any(subset) == set.union(*[set(stores[name]) for name in subset])
+for name, rules in stores.items():
+    for key, conf in rules.items():
+        assert store_index.confidences(key)[name] == conf
+
+print("\n(Passed!)")
+
+
+# ## More rule metrics, all at once
+# 
+# Confidence is not the only way to score a rule. If $N$ is the number of receipts and $n_a$, $n_b$ and $n_{ab}$ are the item and pair counts, some other common measures are:
+# 
+# - _lift_, $\mathrm{lift}(a \Rightarrow b) = \dfrac{\mathrm{conf}(a \Rightarrow b)}{n_b / N} = \dfrac{N \, n_{ab}}{n_a \, n_b}$, which is 1 when $a$ and $b$ are independent;
+# - _leverage_, $\dfrac{n_{ab}}{N} - \dfrac{n_a}{N} \cdot \dfrac{n_b}{N}$, which is 0 when they are independent; and
+# - _conviction_, $\dfrac{1 - n_b / N}{1 - \mathrm{conf}(a \Rightarrow b)}$, which is infinite when the rule always holds.
+# 
+# `filter_rules_by_conf` loops over the keys in Python, recomputing the same division up to three times per key, and can only filter on confidence. The function `compute_rule_metrics` works on the count arrays of the sparse backend instead: with the candidate rules laid out as parallel arrays, it computes all four metrics for all of them with a handful of NumPy operations. `filter_rules_by_metrics` then applies any combination of minimum values, as well as the minimum antecedent count, as boolean masks, so filtering on several metrics costs about as much as filtering on one.
+
+# In[ ]:
+
+
+RULE_METRICS = ('conf', 'lift', 'leverage', 'conviction')
+
+def compute_rule_metrics(item_counts, pair_counts, num_receipts):
+    """
+    Given item counts and a sparse pair-count matrix, returns a
+    dictionary of parallel arrays, one entry per candidate rule a => b:
+    the item ids 'a' and 'b', the counts 'count_a' and 'count_ab', and
+    each of the `RULE_METRICS`.
+    """
+    C = pair_counts.tocoo()
+    n_a, n_b, n_ab = item_counts[C.row], item_counts[C.col], C.data
+    N = num_receipts
+    conf = n_ab / n_a
+    p_b = n_b / N
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conviction = (1 - p_b) / (1 - conf)
+    conviction[conf == 1] = np.inf # including 0/0, when b is in every receipt
+    return {'a': C.row, 'b': C.col, 'count_a': n_a, 'count_ab': n_ab,
+            'conf': conf, 'lift': conf / p_b, 'leverage': n_ab / N - (n_a / N) * p_b,
+            'conviction': conviction}
+
+def filter_rules_by_metrics(items, metrics, count=None, value='conf', **min_values):
+    """
+    Returns the rules whose metrics are at least the given `min_values`
+    (e.g., `conf=0.5, lift=2`) and whose antecedent occurs at least
+    `count` times, as a dictionary mapping (a, b) to the metric `value`.
+    """
+    keep = np.ones(len(metrics['a']), dtype=bool)
+    for name, min_value in min_values.items():
+        assert name in RULE_METRICS, "Unknown metric: {}".format(name)
+        keep &= metrics[name] >= min_value
+    if count is not None:
+        keep &= metrics['count_a'] >= count
+    return {(items[i], items[j]): v for i, j, v in zip(metrics['a'][keep].tolist(),
+                                                      metrics['b'][keep].tolist(),
+                                                      metrics[value][keep].tolist())}
+
+def find_rules_by_metrics(receipts, count=None, value='conf', **min_values):
+    items, X = encode_receipts(receipts)
+    item_counts, pair_counts = count_items_and_pairs(X)
+    metrics = compute_rule_metrics(item_counts, pair_counts, X.shape[0])
+    return filter_rules_by_metrics(items, metrics, count, value, **min_values)
+
+# Demo:
+print("Top basket rules by lift, among those with conf >= 0.3:")
+for (a, b), lift in top_rules(find_rules_by_metrics(l, MIN_COUNT, value='lift', conf=0.3), 5):
+    print("lift({} => {}) = {:.2f}".format(a, b, lift))
+
+
+# In[ ]:
+
+
+# `rule_metrics_test`: Test cell
+check_same_rules(find_rules_by_metrics(l, MIN_COUNT, conf=THRESHOLD), basket_rules)
+check_same_rules(find_rules_by_metrics(norm_latin_itemsets, conf=0.75), latin_rules)
+
+items, X = encode_receipts(l)
+N = X.shape[0]
+metrics = compute_rule_metrics(*count_items_and_pairs(X), N)
+for k in Random(0).sample(range(len(metrics['a'])), 200):
+    a, b = items[metrics['a'][k]], items[metrics['b'][k]]
+    n_a, n_b, n_ab = item_counts[a], item_counts[b], pair_counts[(a, b)]
+    assert metrics['conf'][k] == n_ab / n_a
+    assert abs(metrics['lift'][k] - N * n_ab / (n_a * n_b)) < 1e-12 * metrics['lift'][k]
+    assert abs(metrics['leverage'][k] - (n_ab/N - n_a*n_b/N**2)) < 1e-15
+    if n_ab < n_a:
+        assert abs(metrics['conviction'][k] - (1 - n_b/N) / (1 - n_ab/n_a)) < 1e-12 * metrics['conviction'][k]
+assert all(np.isinf(metrics['conviction'][metrics['conf'] == 1]))
+
+# A consequent in every receipt: conviction is 0/0 at conf == 1, which we also report as infinite
+import warnings
+everywhere_items, X = encode_receipts([set('ab'), set('b'), set('abc')])
+with warnings.catch_warnings():
+    warnings.simplefilter('error')
+    everywhere = compute_rule_metrics(*count_items_and_pairs(X), 3)
+assert not np.isnan(everywhere['conviction']).any()
+assert all(np.isinf(everywhere['conviction'][everywhere['conf'] == 1]))
+
+rules = find_rules_by_metrics(l, MIN_COUNT, value='lift', conf=0.2, lift=1.5, leverage=0.001, conviction=1.1)
+for (a, b), lift in rules.items():
+    n_a, n_b, n_ab = item_counts[a], item_counts[b], pair_counts[(a, b)]
+    assert n_a >= MIN_COUNT and n_ab / n_a >= 0.2 and lift >= 1.5 and n_ab/N - n_a*n_b/N**2 >= 0.001
+
+get_ipython().magic('timeit filter_rules_by_conf(pair_counts, item_counts, THRESHOLD, MIN_COUNT)')
+get_ipython().magic("timeit filter_rules_by_metrics(items, metrics, MIN_COUNT, conf=THRESHOLD, lift=1.5, leverage=0.001, conviction=1.1)")
+
+print("\n(Passed!)")
+
+
+# ## Reading baskets without splitting strings
+# 
+# The basket parsing in Exercise 11 calls `split('\n')` and then `split(',')` on every line. That creates a fresh string object for every single item occurrence, and also leaves a spurious empty basket at the end, from the final newline. Even `iter_baskets`, which skips blank lines, still creates one string per occurrence.
+# 
+# The function `read_baskets` instead works directly on the raw bytes of the file, memory-mapped and viewed as a NumPy array of `uint8`, one block of whole lines at a time:
+# 
+# 1. It locates every separator (`,` or newline) with one vectorized comparison, which gives the start and end of every field (item) and the line it is on. A `\r` before a newline is dropped, and blank lines are skipped, as in `iter_baskets`.
+# 2. It computes a 64-bit polynomial hash of _every_ field at once, from prefix sums over the block: with $h_k = \sum_{j<k} (c_j + 1)\, p^j$, the field $[s, e)$ hashes to $(h_e - h_s)\, p^{-s}$, all modulo $2^{64}$. (Since $p$ is odd, $p^{-1}$ exists modulo $2^{64}$, and unsigned NumPy integers wrap around modulo $2^{64}$ for free.)
+# 3. It interns the _distinct_ hashes into a shared vocabulary, an `ItemInterner`, decoding an item's name only the first time it is seen.
+# 
+# A hash is not a name, though: distinct items can collide, and for polynomial hashes modulo $2^{64}$ it is easy to construct such pairs. So every field is also compared, byte for byte and again vectorized, against the first field in the block with the same hash, and that one against the name already interned under its hash. If any comparison fails, the block falls back to interning each field by its bytes, which is slower but exact.
+# 
+# The result is a `Baskets` object in CSR layout: the vocabulary `items`, an array `indptr` of basket offsets, and an array `indices` of item ids. It behaves like a list of receipts (whose items are references to the shared, interned names), so every backend of `find_assoc_rules` accepts it. Better yet, `encode_receipts` and `prune_receipts` recognize it and use its arrays directly, so the sparse, Apriori and pruning paths never touch the items one by one.
+
+# In[ ]:
+
+
+HASH_PRIME = 0x100000001b3
+
+class Baskets:
+    """
+    A list of receipts in CSR layout: receipt r holds the items with ids
+    `indices[indptr[r]:indptr[r+1]]`, which index the list `items`.
+    """
+    def __init__(self, items, indptr, indices):
+        self.items = items
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, r):
+        return [self.items[i] for i in self.indices[self.indptr[r]:self.indptr[r+1]].tolist()]
+
+    def __iter__(self):
+        for r in range(len(self)):
+            yield self[r]
+
+    def incidence_matrix(self):
+        X = sparse.csr_matrix((np.ones(len(self.indices), dtype=np.int32), self.indices, self.indptr),
+                              shape=(len(self), len(self.items)))
+        X.sum_duplicates()
+        X.data[:] = 1 # Receipts are sets
+        return X
+
+    def item_counts(self):
+        return np.asarray(self.incidence_matrix().sum(axis=0)).ravel()
+
+    def select_items(self, keep):
+        """
+        Returns new `Baskets`, over the same vocabulary, holding only the
+        items whose ids are set in the boolean array `keep`; baskets left
+        empty are dropped.
+        """
+        kept = keep[self.indices]
+        sizes = np.add.reduceat(kept, self.indptr[:-1]) if len(self.indices) else np.zeros(len(self), dtype=np.int64)
+        sizes[self.indptr[:-1] == self.indptr[1:]] = 0 # reduceat does not sum empty segments
+        sizes = sizes[sizes > 0]
+        return Baskets(self.items, np.concatenate([[0], np.cumsum(sizes)]), self.indices[kept])
+
+class FieldHasher:
+    """
+    Computes 64-bit polynomial hashes, with base `HASH_PRIME`, of fields
+    of byte arrays. The powers of the base are computed once and reused.
+    """
+    def __init__(self, size=0):
+        self.powers = np.zeros(0, dtype=np.uint64)
+        self.inv_powers = np.zeros(0, dtype=np.uint64)
+        self.reserve(size)
+
+    def reserve(self, size):
+        if size > len(self.powers):
+            self.powers = np.cumprod(np.full(size, HASH_PRIME, dtype=np.uint64))
+            self.inv_powers = np.concatenate([[np.uint64(1)],
+                                              np.cumprod(np.full(size, pow(HASH_PRIME, -1, 2**64), dtype=np.uint64))])
+
+    def __call__(self, block, starts, ends):
+        """Returns the hash of each field `block[starts[k]:ends[k]]`."""
+        self.reserve(len(block))
+        prefix = np.zeros(len(block)+1, dtype=np.uint64)
+        np.cumsum((block.astype(np.uint64) + np.uint64(1)) * self.powers[:len(block)], out=prefix[1:])
+        return (prefix[ends] - prefix[starts]) * self.inv_powers[starts]
+
+class ItemInterner:
+    """
+    Assigns ids to item names, given as UTF-8 bytes. The decoded names
+    are in `items`; `by_hash` maps a field hash to the id of the first
+    name seen with that hash.
+    """
+    def __init__(self):
+        self.items = []
+        self.names = []
+        self.ids = {}
+        self.by_hash = {}
+
+    def intern(self, name):
+        item_id = self.ids.get(name)
+        if item_id is None:
+            item_id = self.ids[name] = len(self.items)
+            self.names.append(name)
+            self.items.append(name.decode('utf-8'))
+        return item_id
+
+def same_fields(block, starts, ends, other_starts):
+    """
+    Returns True if every field `block[starts[k]:ends[k]]` has the same
+    bytes as the equally long field starting at `other_starts[k]`.
+    """
+    lengths = ends - starts
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    within = np.arange(lengths.sum()) - offsets
+    return (block[np.repeat(starts, lengths) + within] == block[np.repeat(other_starts, lengths) + within]).all()
+
+def _read_basket_block(block, sep, hasher, interner):
+    """
+    Parses a block of whole lines. Returns the number of items in each
+    non-blank basket and the item ids, interning new items into
+    `interner`.
+    """
+    is_newline = block == ord('\n')
+    seps = np.flatnonzero(is_newline | (block == ord(sep)))
+    ends_line = is_newline[seps]
+    if len(block) and block[-1] != ord('\n'): # Last line has no newline
+        seps = np.append(seps, len(block))
+        ends_line = np.append(ends_line, True)
+    starts = np.concatenate([[0], seps[:-1] + 1])
+    ends = seps.copy()
+    while True: # Drop any '\r' before a newline, as rstrip('\r\n') would
+        cr = ends_line & (ends > starts) & (block[np.maximum(ends - 1, 0)] == ord('\r'))
+        if not cr.any():
+            break
+        ends[cr] -= 1
+    line = np.concatenate([[0], np.cumsum(ends_line)[:-1]])
+    fields_per_line = np.bincount(line, minlength=line[-1]+1 if len(line) else 0)
+    blank = (fields_per_line[line] == 1) & (ends == starts)
+    starts, ends, line = starts[~blank], ends[~blank], line[~blank]
+
+    sizes = np.bincount(line, minlength=line[-1]+1 if len(line) else 0)
+
+    hashes = hasher(block, starts, ends)
+    distinct, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    rep_starts, rep_ends = starts[first], ends[first]
+    exact = ((ends - starts) == (rep_ends - rep_starts)[inverse]).all() \
+            and same_fields(block, starts, ends, rep_starts[inverse])
+    distinct_ids = np.empty(len(distinct), dtype=np.int32)
+    for k, (key, s, e) in enumerate(zip(distinct.tolist(), rep_starts.tolist(), rep_ends.tolist())):
+        if not exact:
+            break
+        name = block[s:e].tobytes()
+        item_id = interner.by_hash.get(key)
+        if item_id is None:
+            item_id = interner.by_hash[key] = interner.intern(name)
+        elif interner.names[item_id] != name:
+            exact = False
+        distinct_ids[k] = item_id
+    if not exact: # A hash collision: intern every field by its bytes
+        ids = [interner.intern(block[s:e].tobytes()) for s, e in zip(starts.tolist(), ends.tolist())]
+        return sizes[sizes > 0], np.array(ids, dtype=np.int32)
+    return sizes[sizes > 0], distinct_ids[inverse]
+
+def read_baskets(source, sep=',', block_size=1 << 22):
+    """
+    Reads comma-separated baskets, one per line, from `source`: a file
+    path or a bytes-like buffer (e.g., `mmap`). Returns `Baskets`.
+    """
+    if type(source) is str:
+        if os.path.getsize(source) == 0:
+            return Baskets([], [0], [])
+        with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return read_baskets(buffer, sep, block_size)
+    data = np.frombuffer(source, dtype=np.uint8)
+    hasher = FieldHasher(min(block_size, len(data)))
+    interner = ItemInterner()
+    all_sizes, all_indices = [], []
+    start = 0
+    while start < len(data):
+        end = min(start + block_size, len(data))
+        if end < len(data): # Extend the block to the end of its last line
+            newlines = np.flatnonzero(data[start:end] == ord('\n'))
+            if len(newlines):
+                end = start + newlines[-1] + 1
+            else:
+                newlines = np.flatnonzero(data[end:] == ord('\n'))
+                end = end + newlines[0] + 1 if len(newlines) else len(data)
+        sizes, indices = _read_basket_block(data[start:end], sep, hasher, interner)
+        all_sizes.append(sizes)
+        all_indices.append(indices)
+        start = end
+    sizes = np.concatenate(all_sizes) if all_sizes else np.zeros(0, dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(sizes)])
+    indices = np.concatenate(all_indices) if all_indices else np.zeros(0, dtype=np.int32)
+    del data
+    return Baskets(interner.items, indptr, indices)
+
+# Demo:
+groceries = read_baskets(groceries_path)
+print("{:,} baskets, {:,} items, {:,} distinct items".format(len(groceries), len(groceries.indices), len(groceries.items)))
+print("First three baskets:", [groceries[r] for r in range(3)])
+
+
+# In[ ]:
+
+
+# `read_baskets_test`: Test cell
+assert list(groceries) == list(iter_baskets(groceries_path))
+for block_size in [7, 1000]:
+    assert list(read_baskets(groceries_path, block_size=block_size)) == list(iter_baskets(groceries_path))
+
+tricky = "a,b\r\n\nc,,a\n\n\r\nβ,crème brûlée,a\n,\nb"
+tricky_baskets = read_baskets(tricky.encode('utf-8'), block_size=4)
+assert list(tricky_baskets) == list(iter_baskets(StringIO(tricky)))
+assert len(read_baskets(b'')) == 0 and len(read_baskets(b'\n\n')) == 0
+
+# Distinct items whose hashes collide are still told apart: these two Thue-Morse strings
+# have the same length, byte sum and polynomial hash modulo 2^64
+thue_morse = np.zeros(2048, dtype=np.uint8)
+for k in range(11):
+    thue_morse[1 << k:2 << k] = 1 - thue_morse[:1 << k]
+collide_a, collide_b = (b'ab'[0] + thue_morse).tobytes(), (b'ab'[0] + 1 - thue_morse).tobytes()
+hasher = FieldHasher()
+assert collide_a != collide_b and len(set(hasher(np.frombuffer(collide_a + collide_b, dtype=np.uint8),
+                                                 np.array([0, 2048]), np.array([2048, 4096])).tolist())) == 1
+for data in [collide_a + b',x\n' + collide_b + b'\n' + collide_a, collide_b + b',' + collide_a + b'\n' + collide_a]:
+    for block_size in [100, 5000, 1 << 22]: # collisions across blocks, and within one
+        collided = read_baskets(data, block_size=block_size)
+        assert {collide_a.decode(), collide_b.decode()} <= set(collided.items)
+        assert len(collided.items) == len(set(collided.items))
+        assert list(collided) == list(iter_baskets(StringIO(data.decode())))
+
+# Occurrences share one interned string per item
+assert groceries[0][0] is groceries.items[groceries.indices[0]]
+
+for backend in ASSOC_RULE_BACKENDS:
+    if backend != 'bitmask':
+        check_same_rules(find_assoc_rules(groceries, THRESHOLD, MIN_COUNT, backend=backend), basket_rules)
+check_same_rules(find_assoc_rules(groceries, 0.2, backend='sparse'), find_assoc_rules(l, 0.2))
+letters = read_baskets('\n'.join(','.join(word) for word in norm_latin_words).encode())
+check_same_rules(find_assoc_rules(letters, 0.75, backend='bitmask'), latin_rules)
+pruned = prune_receipts(groceries, THRESHOLD, MIN_COUNT)
+assert type(pruned) is Baskets
+assert [sorted(rep) for rep in pruned] == [sorted(rep) for rep in prune_receipts(l, THRESHOLD, MIN_COUNT)]
+
+print("\n(Passed!)")
+
+
+# From the file to the rules, with string splitting versus `read_baskets`:
+
+# In[ ]:
+
+
+get_ipython().magic("timeit find_assoc_rules([r.split(',') for r in open(groceries_path).read().split('\\n')], THRESHOLD, MIN_COUNT, backend='sparse')")
+get_ipython().magic("timeit find_assoc_rules(read_baskets(groceries_path), THRESHOLD, MIN_COUNT, backend='sparse')")
+
+
+# ## Serving rules by antecedent
+# 
+# Once the rules are mined, an application typically asks questions of the form, "the customer just picked up $a$; what else are they likely to buy?" Answering that from the rules dictionary means scanning every rule to find those whose antecedent is $a$, which is far too slow to do on every request.
+# 
+# The class `RuleStore` builds an _inverted index_ from each antecedent to its consequents. Items are interned as ids, and the rules are stored in three arrays, in the same compressed sparse row (CSR) layout as a `scipy.sparse` matrix:
+# 
+# - `consequents` and `conf` list the consequent ids and confidences of all rules, grouped by antecedent and, within each group, sorted by decreasing confidence (ties broken by item name);
+# - `indptr[i]:indptr[i+1]` is the range of those arrays holding the rules whose antecedent is item `i`.
+# 
+# The method `lookup(a, k)` is then one dictionary lookup plus a slice, no matter how many rules there are, and the first `k` entries of the slice are the `k` best rules. The method `recommend(basket, k)` looks up every item of a basket at once: it gathers their slices, drops the items already in the basket, and keeps each remaining consequent's best confidence.
+# 
+# Rules from `find_assoc_rules(..., backend='apriori')` may have a tuple of items as their antecedent. The store interns such an antecedent like any other item (and `lookup` accepts its items in any order), and `recommend` also gathers the rules of every such antecedent whose items are all in the basket. Only stores of pairwise rules can be saved, though, since the file holds item names as strings.
+# 
+# Lastly, `save` writes a store with `write_table_file`, and `RuleStore.load` memory-maps it back with `read_table_file`. Because the arrays are read-only views of the file, any number of worker processes can load the same snapshot and the operating system keeps just one copy of it in memory.
+
+# In[ ]:
+
+
+RULE_STORE_MAGIC = b'RULESTR1'
+
+class RuleStore:
+    """
+    A read-only index from each antecedent to its consequents, sorted by
+    decreasing confidence.
+    """
+    def __init__(self, items, indptr, consequents, conf):
+        self.items = items
+        self.item_ids = {item: i for i, item in enumerate(items)}
+        # Multi-item antecedents (see `find_assoc_rules_apriori`), by their set of items
+        self.itemset_ids = {frozenset(item): i for i, item in enumerate(items) if type(item) is tuple}
+        self.max_antecedent_size = max((len(itemset) for itemset in self.itemset_ids), default=1)
+        self.indptr = indptr
+        self.consequents = consequents
+        self.conf = conf
+
+    @classmethod
+    def from_rules(cls, rules):
+        """
+        Builds a store from a dictionary of rules, `{(a, b): conf}`, where
+        an antecedent `a` may also be a tuple of items.
+        """
+        # Consequents first, by name, so that ids break ties by name; then
+        # any other antecedents (which may be tuples), as first seen
+        item_ids = {b: i for i, b in enumerate(sorted({b for _, b in rules}))}
+        a = np.array([item_ids.setdefault(a, len(item_ids)) for a, _ in rules], dtype='<i8')
+        b = np.array([item_ids[b] for _, b in rules], dtype='<i8')
+        items = list(item_ids)
+        conf = np.array(list(rules.values()), dtype='<f8')
+        order = np.lexsort((b, -conf, a))
+        indptr = np.zeros(len(items)+1, dtype='<i8')
+        indptr[1:] = np.cumsum(np.bincount(a, minlength=len(items)))
+        return cls(items, indptr, b[order], conf[order])
+
+    @classmethod
+    def load(cls, path):
+        items, arrays = read_table_file(path, RULE_STORE_MAGIC, ['<i8', '<i8', '<f8'])
+        return cls(items, *arrays)
+
+    def save(self, path):
+        if self.itemset_ids:
+            raise ValueError("Only stores of pairwise rules can be saved, not multi-item antecedents")
+        write_table_file(path, RULE_STORE_MAGIC, self.items, [self.indptr, self.consequents, self.conf])
+
+    def __len__(self):
+        return len(self.conf)
+
+    def lookup(self, a, k=None):
+        """
+        Returns the rules with antecedent `a` (an item, or a tuple of
+        items in any order), as a list of `(consequent, conf)` pairs, best
+        first; at most `k` if given.
+        """
+        i = self.itemset_ids.get(frozenset(a)) if type(a) is tuple else self.item_ids.get(a)
+        if i is None:
+            return []
+        start, end = self.indptr[i], self.indptr[i+1]
+        if k is not None:
+            end = min(end, start + k)
+        return [(self.items[j], conf) for j, conf in zip(self.consequents[start:end].tolist(),
+                                                          self.conf[start:end].tolist())]
+
+    def recommend(self, basket, k=None):
+        """
+        Returns the consequents of all rules whose antecedent is in
+        `basket` (or, for a tuple, all of whose items are), other than
+        items already in `basket`, as a list of `(consequent, conf)` pairs
+        with the best confidence for each, best first; at most `k` if given.
+        """
+        ids = [self.item_ids[a] for a in basket if a in self.item_ids]
+        for size in range(2, self.max_antecedent_size+1):
+            ids += [self.itemset_ids[itemset] for itemset in map(frozenset, combinations(basket, size))
+                    if itemset in self.itemset_ids]
+        ids = np.array(ids, dtype='<i8')
+        starts, ends = self.indptr[ids], self.indptr[ids+1]
+        sizes = ends - starts
+        # Positions of all rules in the gathered slices, without a Python loop
+        offsets = np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+        positions = offsets + np.arange(sizes.sum())
+        consequents, conf = self.consequents[positions], self.conf[positions]
+        keep = ~np.isin(consequents, ids)
+        consequents, conf = consequents[keep], conf[keep]
+        order = np.lexsort((-conf, consequents))
+        _, first = np.unique(consequents[order], return_index=True)
+        best = order[first]
+        best = best[np.lexsort((consequents[best], -conf[best]))][:k]
+        return [(self.items[j], c) for j, c in zip(consequents[best].tolist(), conf[best].tolist())]
+
+_open_rule_stores = {}
+
+def open_rule_store(path):
+    """Loads the store at `path` once per process and reuses it."""
+    if path not in _open_rule_stores:
+        _open_rule_stores[path] = RuleStore.load(path)
+    return _open_rule_stores[path]
+
+def recommend_from_store(request):
+    """
+    Worker for a pool from `notebook_pool_context`: `request` is a tuple
+    `(path, basket, k)`.
+    """
+    path, basket, k = request
+    return open_rule_store(path).recommend(basket, k)
+
+# Demo:
+basket_store = RuleStore.from_rules(filter_rules_by_conf(pair_counts, item_counts, 0.0))
+print("{:,} rules over {:,} antecedents".format(len(basket_store), len(basket_store.items)))
+print("Top rules for 'whole milk':", basket_store.lookup('whole milk', 3))
+print("Recommendations for", l[0], ":", basket_store.recommend(l[0], 3))
+
+
+# In[ ]:
+
+
+# `rule_store_test`: Test cell
+def scan_lookup(rules, a):
+    found = [(b, conf) for (x, b), conf in rules.items() if x == a]
+    return sorted(found, key=lambda bc: (-bc[1], bc[0]))
+
+def scan_recommend(rules, basket):
+    best = {}
+    for (a, b), conf in rules.items():
+        if (set(a) <= set(basket) if type(a) is tuple else a in basket) and b not in basket:
+            best[b] = max(best.get(b, 0.0), conf)
+    return sorted(best.items(), key=lambda bc: (-bc[1], bc[0]))
+
+all_basket_rules = filter_rules_by_conf(pair_counts, item_counts, 0.0)
+for rules in [all_basket_rules, basket_rules, latin_rules, {}]:
+    store = RuleStore.from_rules(rules)
+    assert len(store) == len(rules)
+    antecedents = {a for a, _ in rules}
+    for a in antecedents:
+        assert store.lookup(a) == scan_lookup(rules, a)
+        assert store.lookup(a, 2) == scan_lookup(rules, a)[:2]
+    assert store.lookup('no such item') == []
+    for basket in l[:200] + [set(), {'no such item'}, set(antecedents)]:
+        assert store.recommend(basket) == scan_recommend(rules, basket)
+        assert store.recommend(basket, 5) == scan_recommend(rules, basket)[:5]
+
+# Rules with multi-item antecedents, which mix tuples with items
+apriori_rules = find_assoc_rules(norm_latin_itemsets, 0.75, backend='apriori', max_size=3)
+apriori_store = RuleStore.from_rules(apriori_rules)
+assert len(apriori_store) == len(apriori_rules) and apriori_store.max_antecedent_size == 2
+for a in {a for a, _ in apriori_rules}:
+    assert apriori_store.lookup(a) == scan_lookup(apriori_rules, a)
+    if type(a) is tuple:
+        assert apriori_store.lookup(a[::-1]) == scan_lookup(apriori_rules, a)
+for basket in norm_latin_itemsets[:200]:
+    assert apriori_store.recommend(basket) == scan_recommend(apriori_rules, basket)
+try:
+    apriori_store.save(scratch_path('latin.rules'))
+    assert False, "Expected a ValueError"
+except ValueError:
+    pass
+
+rules_path = scratch_path('groceries.rules')
+basket_store.save(rules_path)
+loaded = RuleStore.load(rules_path)
+assert loaded.items == basket_store.items and len(loaded) == len(basket_store)
+assert not loaded.conf.flags.owndata and not loaded.conf.flags.writeable # a view into the file
+assert all(loaded.recommend(basket, 5) == basket_store.recommend(basket, 5) for basket in l[:100])
+if notebook_pool_context() is not None: # see `find_assoc_rules_parallel`
+    with notebook_pool_context().Pool(2) as pool:
+        served = pool.map(recommend_from_store, [(rules_path, basket, 5) for basket in l[:100]])
+    assert served == [basket_store.recommend(basket, 5) for basket in l[:100]]
+
+get_ipython().magic("timeit basket_store.lookup('whole milk', 5)")
+get_ipython().magic("timeit scan_lookup(all_basket_rules, 'whole milk')[:5]")
+get_ipython().magic("timeit basket_store.recommend(l[0], 5)")
+
+print("\n(Passed!)")
+
+
+# ## Previewing the rules on a sample
+# 
+# When choosing `threshold` and `count` for a large collection of receipts, an analyst does not need the exact rules, just a reliable preview. A random sample of the receipts gives one quickly.
+# 
+# If $n_a$ of the sampled receipts contain $a$ and $n_{ab}$ of those also contain $b$, then $n_{ab}/n_a$ estimates $\mathrm{conf}(a \Rightarrow b)$. Since it is the fraction of "successes" among $n_a$ receipts, we can bound it with the _Wilson score interval_: with $\hat{p} = n_{ab}/n_a$ and $z = 1.96$ for 95% confidence,
+# 
+# $$
+#   \frac{\hat{p} + \frac{z^2}{2n_a} \pm z\sqrt{\frac{\hat{p}(1-\hat{p})}{n_a} + \frac{z^2}{4n_a^2}}}{1 + \frac{z^2}{n_a}}.
+# $$
+# 
+# The sample is drawn by `sample_order`, which puts the receipts in a random order, so that every prefix of it is a uniform random sample. Optionally, given a _stratum_ label for each receipt (say, its month or store), it interleaves the strata so that every prefix is also a _stratified_ sample, with each stratum represented in proportion to its size.
+# 
+# The generator `iter_preview_rules` then widens the sample progressively, by a factor of `growth` each round. It counts only the receipts that are new to the sample, with `count_receipts`, adds them into the running tables with `merge_counts`, and yields the estimated rules. The minimum `count` is scaled down to the size of the sample. Finally, `find_assoc_rules_preview` stops as soon as the rule set stabilizes, i.e., when the rules of two consecutive rounds have a Jaccard similarity of at least `stability`.
+
+# In[ ]:
+
+
+from math import sqrt
+
+def sample_order(num_receipts, strata=None, seed=6040):
+    """
+    Returns a random permutation of `range(num_receipts)`. If `strata`
+    gives a label for each receipt, every prefix of the permutation has
+    each stratum in proportion to its size.
+    """
+    rng = Random(seed)
+    if strata is None:
+        order = list(range(num_receipts))
+        rng.shuffle(order)
+        return order
+    assert len(strata) == num_receipts
+    members = defaultdict(list)
+    for r, label in enumerate(strata):
+        members[label].append(r)
+    keyed = []
+    for label in members:
+        rng.shuffle(members[label])
+        offset, size = rng.random(), len(members[label])
+        keyed.extend(((k + offset) / size, r) for k, r in enumerate(members[label]))
+    keyed.sort()
+    return [r for _, r in keyed]
+
+def sample_receipts(receipts, size, strata=None, seed=6040):
+    """Returns a (possibly stratified) random sample of `size` receipts."""
+    return [receipts[r] for r in sample_order(len(receipts), strata, seed)[:size]]
+
+def conf_interval(pair_count, item_count, z=1.96):
+    """The Wilson score interval for the confidence `pair_count / item_count`."""
+    p = pair_count / item_count
+    denom = 1 + z*z/item_count
+    center = (p + z*z/(2*item_count)) / denom
+    half = z * sqrt(p*(1-p)/item_count + z*z/(4*item_count*item_count)) / denom
+    # Clamp, so that rounding cannot push the ends past `p` when it is 0 or 1
+    return max(min(center - half, p), 0.0), min(max(center + half, p), 1.0)
+
+def estimate_rules(pair_counts, item_counts, threshold, count=None, z=1.96):
+    """
+    Like `filter_rules_by_conf`, but for counts from a sample: maps each
+    rule to a tuple `(conf, low, high)` with its estimated confidence and
+    confidence interval.
+    """
+    rules = filter_rules_by_conf(pair_counts, item_counts, threshold, count)
+    return {(a, b): (conf,) + conf_interval(pair_counts[(a, b)], item_counts[a], z)
+            for (a, b), conf in rules.items()}
+
+def iter_preview_rules(receipts, threshold, count=None, sample_size=1000, growth=2, strata=None, z=1.96, seed=6040):
+    """
+    Estimates the rules on progressively larger samples of `receipts`,
+    yielding `(num_sampled, rules)` after each round, where `rules` is as
+    returned by `estimate_rules`. The last round covers all receipts.
+    """
+    assert growth > 1 and sample_size >= 1, "Each round must sample more receipts"
+    order = sample_order(len(receipts), strata, seed)
+    tables = (defaultdict(int), defaultdict(int))
+    num_sampled = 0
+    while num_sampled < len(receipts):
+        size = max(int(num_sampled * growth), sample_size, num_sampled + 1)
+        size = min(size, len(receipts))
+        merge_counts(tables, count_receipts(receipts[r] for r in order[num_sampled:size]))
+        num_sampled = size
+        sample_count = None if count is None else count * num_sampled / len(receipts)
+        item_counts, pair_counts = tables
+        yield num_sampled, estimate_rules(pair_counts, item_counts, threshold, sample_count, z)
+
+def rule_set_similarity(rules, other):
+    """The Jaccard similarity of the rule sets (keys) of `rules` and `other`."""
+    union = len(rules.keys() | other.keys())
+    return len(rules.keys() & other.keys()) / union if union else 1.0
+
+def find_assoc_rules_preview(receipts, threshold, count=None, stability=0.95, **options):
+    """
+    Widens a sample of `receipts` until the estimated rule set stabilizes.
+    Returns `(num_sampled, rules)`; see `iter_preview_rules`.
+    """
+    previous, num_sampled, rules = None, 0, {}
+    for num_sampled, rules in iter_preview_rules(receipts, threshold, count, **options):
+        if previous is not None and rule_set_similarity(rules, previous) >= stability:
+            break
+        previous = rules
+    return num_sampled, rules
+
+# Demo:
+num_sampled, preview_rules = find_assoc_rules_preview(l, THRESHOLD, MIN_COUNT, sample_size=500)
+print("Stabilized after sampling {:,} of {:,} receipts:".format(num_sampled, len(l)))
+for (a, b), (conf, low, high) in sorted(preview_rules.items(), key=lambda kv: -kv[1][0])[:10]:
+    print("{}  [{:.3f}, {:.3f}]".format(gen_rule_str(a, b, conf, sep=" ~ "), low, high))
+
+
+# In[ ]:
+
+
+# `preview_rules_test`: Test cell
+order = sample_order(len(l))
+assert sorted(order) == list(range(len(l))) and order != list(range(len(l)))
+assert sample_order(len(l), seed=1) != order and sample_order(len(l)) == order
+assert sample_receipts(l, 10) == [l[r] for r in order[:10]]
+
+# Every prefix of a stratified order is proportional, to within two receipts per stratum
+strata = [len(rep) % 3 for rep in l]
+sizes = {label: strata.count(label) for label in set(strata)}
+stratified = sample_order(len(l), strata)
+assert sorted(stratified) == list(range(len(l)))
+seen = defaultdict(int)
+for n, r in enumerate(stratified, 1):
+    seen[strata[r]] += 1
+    for label, size in sizes.items():
+        assert abs(seen[label] - n * size / len(l)) < 2
+
+assert all(conf_interval(0, n)[0] == 0.0 and conf_interval(n, n)[1] == 1.0 for n in range(1, 100))
+low, high = conf_interval(30, 100)
+assert low < 0.3 < high and abs(high - low - 0.18) < 0.01
+
+# The last round is the full data set, so it must be exact
+rounds = list(iter_preview_rules(l, THRESHOLD, MIN_COUNT, sample_size=300, growth=3))
+assert [n for n, _ in rounds] == sorted({min(300 * 3**k, len(l)) for k in range(20)})
+assert rounds[-1][0] == len(l)
+check_same_rules({key: conf for key, (conf, _, _) in rounds[-1][1].items()}, basket_rules)
+for _, rules in rounds:
+    assert all(low <= conf <= high for conf, low, high in rules.values())
+
+small_rounds = list(iter_preview_rules(l[:20], THRESHOLD, MIN_COUNT, sample_size=1, growth=1.5))
+assert [n for n, _ in small_rounds][:6] == [1, 2, 3, 4, 6, 9] and small_rounds[-1][0] == 20
+for sample_size, growth in [(500, 1), (0, 2)]:
+    try:
+        next(iter_preview_rules(l, THRESHOLD, MIN_COUNT, sample_size=sample_size, growth=growth))
+        assert False, "Expected an AssertionError"
+    except AssertionError as err:
+        assert str(err) == "Each round must sample more receipts"
+
+stratified_rounds = list(iter_preview_rules(l, THRESHOLD, MIN_COUNT, strata=strata))
+check_same_rules({key: conf for key, (conf, _, _) in stratified_rounds[-1][1].items()}, basket_rules)
+
+num_sampled, rules = find_assoc_rules_preview(l, THRESHOLD, MIN_COUNT, sample_size=500)
+assert num_sampled <= len(l) and rules == dict(iter_preview_rules(l, THRESHOLD, MIN_COUNT, sample_size=500))[num_sampled]
+assert find_assoc_rules_preview(l, THRESHOLD, MIN_COUNT, stability=1.1)[0] == len(l)
+assert find_assoc_rules_preview([], 0.5) == (0, {})
+
+print("\n(Passed!)")
+
+
+# ## Rules over a sliding window
+# 
+# For monitoring, say, promotions or fraud, we often want the rules over only the most recent receipts: the last $N$ of them, or those from the last $T$ minutes. That is a sliding window: each new receipt enters it, and the oldest receipts leave it.
+# 
+# The class `SlidingWindowMiner` keeps its counts in an `AssocRuleMiner`. It holds the receipts in the window in a queue, along with their timestamps. The method `add(receipt, timestamp)` counts the new receipt in, then counts out the receipts that have fallen out of the window, either because there are more than `max_receipts` of them or because they are older than `max_age`; `advance(timestamp)` does just the latter, for when time passes without new receipts. The timestamps may be numbers or `datetime` objects, as long as `max_age` is of the matching type (e.g., a `timedelta`); a window without a `max_age` may also leave them out, but not only for some receipts. Since receipts leave the window only as it slides, there is no `remove_receipts`: the `AssocRuleMiner` is used as a part, not extended.
+# 
+# Each receipt enters and leaves the window exactly once, and doing so updates only its own items and pairs. However, re-checking the rules of an item $a$, as `AssocRuleMiner` does after each update, costs time proportional to the number of items ever seen with $a$, which grows with the window. So instead, updates just mark the affected items as _dirty_, and `current_rules()` re-checks the dirty items when the rules are actually requested. An update then costs time proportional to the number of pairs in the receipts that enter or leave, independent of the window size, and an item that changes many times between two requests is re-checked only once.
+
+# In[ ]:
+
+
+from collections import deque
+
+class SlidingWindowMiner:
+    """
+    Maintains the rules over the most recent receipts: at most
+    `max_receipts` of them, and only those at most `max_age` old.
+    """
+    def __init__(self, threshold, count=None, max_receipts=None, max_age=None):
+        assert max_receipts is not None or max_age is not None, "Need a window size"
+        self.max_receipts = max_receipts
+        self.max_age = max_age
+        self.window = deque() # (timestamp, receipt), oldest first
+        self.timestamped = None # Whether the receipts have timestamps, once known
+        self.miner = AssocRuleMiner(threshold, count)
+        self.dirty = set()
+
+    def _update(self, receipt, delta):
+        self.dirty.update(self.miner._count([receipt], delta))
+
+    def add_receipts(self, receipts, timestamp=None):
+        """Adds each of `receipts`, all seen at `timestamp`, sliding the window."""
+        for rep in receipts:
+            self.add(rep, timestamp)
+
+    def add(self, receipt, timestamp=None):
+        """Adds `receipt`, seen at `timestamp`, and slides the window."""
+        assert self.max_age is None or timestamp is not None, "Need a timestamp"
+        if self.timestamped is None:
+            self.timestamped = timestamp is not None
+        assert self.timestamped == (timestamp is not None), "Mixed receipts with and without timestamps"
+        assert not self.window or timestamp is None or timestamp >= self.window[-1][0], "Out of order"
+        receipt = set(receipt)
+        self.window.append((timestamp, receipt))
+        self._update(receipt, 1)
+        while self.max_receipts is not None and len(self.window) > self.max_receipts:
+            self._update(self.window.popleft()[1], -1)
+        self.advance(timestamp)
+
+    def advance(self, timestamp):
+        """
+        Removes the receipts older than `max_age` as of `timestamp`. (Without
+        a `max_age`, receipts never age out, so this does nothing.)
+        """
+        if self.max_age is None:
+            return
+        while self.window and self.window[0][0] <= timestamp - self.max_age:
+            self._update(self.window.popleft()[1], -1)
+
+    def current_rules(self):
+        """Returns the rules over the receipts now in the window."""
+        while self.dirty:
+            self.miner._refresh(self.dirty.pop())
+        return self.miner.rules
+
+# Demo:
+window_miner = SlidingWindowMiner(0.6, max_receipts=2)
+for rep in [set('abbc'), set('ac'), set('a'), set('bc')]:
+    window_miner.add(rep)
+    print("After adding {}, the window holds {}:".format(sorted(rep), [sorted(r) for _, r in window_miner.window]))
+    print_rules(window_miner.current_rules())
+
+
+# In[ ]:
+
+
+# `sliding_window_miner_test`: Test cell
+rng = Random(2)
+timestamps = sorted(rng.uniform(0, 60) for _ in l)
+for max_receipts, max_age in [(500, None), (None, 5.0), (800, 10.0), (1, None)]:
+    window_miner = SlidingWindowMiner(THRESHOLD, MIN_COUNT, max_receipts, max_age)
+    for step, (timestamp, rep) in enumerate(zip(timestamps, l)):
+        window_miner.add(rep, timestamp)
+        if step % 250 == 0 or step == len(l) - 1:
+            in_window = [r for t, r in zip(timestamps[:step+1], l[:step+1])
+                         if max_age is None or t > timestamp - max_age][-(max_receipts or len(l)):]
+            assert [r for _, r in window_miner.window] == [set(r) for r in in_window]
+            check_same_rules(window_miner.current_rules(), find_assoc_rules(in_window, THRESHOLD, MIN_COUNT))
+
+window_miner = SlidingWindowMiner(THRESHOLD, max_age=5.0)
+for timestamp, rep in zip(timestamps, l):
+    window_miner.add(rep, timestamp)
+window_miner.advance(timestamps[-1] + 5.0)
+assert not window_miner.window and not window_miner.current_rules()
+assert not window_miner.miner.item_counts and not window_miner.miner.pair_counts and not window_miner.miner.neighbors
+
+# Memory follows the window, even if nobody asks for the rules
+window_miner = SlidingWindowMiner(THRESHOLD, max_receipts=100)
+for rep in synthetic_baskets:
+    window_miner.add(rep)
+window_counts = count_receipts([r for _, r in window_miner.window])
+assert dict(window_miner.miner.item_counts) == window_counts[0] and dict(window_miner.miner.pair_counts) == window_counts[1]
+assert sum(map(len, window_miner.miner.neighbors.values())) == len(window_miner.miner.pair_counts)
+assert set(window_miner.miner.rules) <= set(window_miner.miner.pair_counts)
+check_same_rules(window_miner.current_rules(), find_assoc_rules([r for _, r in window_miner.window], THRESHOLD))
+
+window_miner.add_receipts(l[:150], timestamp=None)
+assert [r for _, r in window_miner.window] == [set(r) for r in l[50:150]]
+window_miner.advance(1e9) # Nothing ages out of a window without a `max_age`
+assert len(window_miner.window) == 100
+
+# Receipts with and without timestamps do not mix
+for timestamps_in in [[None, 1.0], [1.0, None]]:
+    window_miner = SlidingWindowMiner(THRESHOLD, max_receipts=10)
+    window_miner.add(l[0], timestamps_in[0])
+    try:
+        window_miner.add(l[1], timestamps_in[1])
+        assert False, "Expected an AssertionError"
+    except AssertionError as err:
+        assert str(err) == "Mixed receipts with and without timestamps"
+
+from datetime import datetime, timedelta
+window_miner = SlidingWindowMiner(0.5, max_age=timedelta(minutes=10))
+start = datetime(2016, 1, 1)
+window_miner.add(set('ab'), start)
+window_miner.add(set('ac'), start + timedelta(minutes=5))
+check_same_rules(window_miner.current_rules(), find_assoc_rules([set('ab'), set('ac')], 0.5))
+window_miner.add(set('bc'), start + timedelta(minutes=12))
+check_same_rules(window_miner.current_rules(), find_assoc_rules([set('ac'), set('bc')], 0.5))
+
+# The cost of an update does not depend on the size of the window
+def fill_window(size):
+    window_miner = SlidingWindowMiner(THRESHOLD, MIN_COUNT, max_receipts=size)
+    for rep in synthetic_baskets[:size]:
+        window_miner.add(rep)
+    return window_miner
+small_window, large_window = fill_window(100), fill_window(10000)
+get_ipython().magic('timeit -n 1 -r 1 [small_window.add(rep) for rep in synthetic_baskets[-2000:]]')
+get_ipython().magic('timeit -n 1 -r 1 [large_window.add(rep) for rep in synthetic_baskets[-2000:]]')
+
+print("\n(Passed!)")